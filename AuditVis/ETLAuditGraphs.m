@@ -31,11 +31,18 @@ function ETLAuditGraphs(startdate,enddate,varargin)
 % Figures are created separately for different protocol groupings (i.e.
 % infant protocols, toddler protocols, and school age protocols), as well
 % as for each protocol on its own. They are saved in separate
-% subdirectories.
-% * Remember to update the list of protocols over time (see the variable
-% graphLoop, which is set near the top of the script).
+% subdirectories. The results of each query are split by protocol group
+% (see PARTITIONRESULTS), and each group's graphs are made from its own
+% results file.
+% The date-filtered session and run results are put together from the day
+% stores in weeklyCheckQuery.py (see flexibleQuery.py --day-store), which
+% QueryTools/prefetchQuery.py fills ahead of time (e.g. overnight), so only
+% the days that aren't stored yet (or are out of date) are queried.
+% * Remember to update the list of protocols over time (see
+% QueryTools/protocolGroups.csv, which is read into the variable graphLoop).
 %
-% See also: AUDITQUERY, READINQUERY, SESSIONAUDITGRAPHS, RUNAUDITGRAPHS
+% See also: AUDITQUERY, READINQUERY, PARTITIONRESULTS, SESSIONAUDITGRAPHS,
+% RUNAUDITGRAPHS
 
 % TODO
 % > Analysis types x protocol 
@@ -55,23 +62,8 @@ finalWarnings = {};
 baseQueryDir = '/Users/etl/Desktop/DataQueries/BaseQueries/'; % where base queries are saved
 mainResultsDir = '/Users/etl/Desktop/DataQueries/Graphs/'; % subdirectories will be created (named by date)
 
-% This should be updated/checked periodically
-field_names = {'dir', 'title', 'protocol'};
-setup_loop = {'AllInfants', 'All Infant Protocols', {'ace-center-2012.eye-tracking-0-36m-2012-11';'infant-sibs.infant-sibs-high-risk-2011-12';'infant-sibs.infant-sibs-low-risk-2011-12'};
-            'AllToddlers', 'All Toddler Protocols', {'toddler.toddler-asd-dd-2011-07','toddler.toddler-asd-dd-2012-11','toddler.toddler-td-2011-07','wash-u.toddler-twin-longitudinal-nontwinsib-2013-06','wash-u.toddler-twin-longitudinal-twinsib-2013-06'};
-            'AllSchoolAge', 'All School Age Protocols', {'school-age.school-age-asf-fellowship-asd-dd-2012-07','school-age.school-age-asf-fellowship-td-2012-07'};
-            'ace-center-2012.eye-tracking-0-36m-2012-11', 'ACE Eye Tracking 0-36M 2012-11', {'ace-center-2012.eye-tracking-0-36m-2012-11'};
-            'infant-sibs.infant-sibs-high-risk-2011-12', 'Infant Sibs High Risk 2011-12', {'infant-sibs.infant-sibs-high-risk-2011-12'};
-            'infant-sibs.infant-sibs-low-risk-2011-12', 'Infant Sibs Low Risk 2011-12', {'infant-sibs.infant-sibs-low-risk-2011-12'};
-            'toddler.toddler-asd-dd-2011-07', 'Toddler ASD-DD 2011-07', {'toddler.toddler-asd-dd-2011-07'};
-            'toddler.toddler-asd-dd-2012-11', 'Toddler ASD-DD 2012-12', {'toddler.toddler-asd-dd-2012-11'};
-            'toddler.toddler-td-2011-07', 'Toddler TD 2011-07', {'toddler.toddler-td-2011-07'};
-            'school-age.school-age-asf-fellowship-asd-dd-2012-07', 'School Age ASF Fellowship ASD-DD 2012-07', {'school-age.school-age-asf-fellowship-asd-dd-2012-07'};
-            'school-age.school-age-asf-fellowship-td-2012-07', 'School Age ASF Fellowship TD 2012-07', {'school-age.school-age-asf-fellowship-td-2012-07'};
-            'wash-u.toddler-twin-longitudinal-nontwinsib-2013-06', 'Wash U Toddler Twin Longitudinal Non-Twin Sib 2013-06', {'wash-u.toddler-twin-longitudinal-nontwinsib-2013-06'};
-            'wash-u.toddler-twin-longitudinal-twinsib-2013-06', 'Wash U Toddler Twin Longitudinal Twin Sib 2013-06', {'wash-u.toddler-twin-longitudinal-twinsib-2013-06'};
-};
-graphLoop = cell2struct(setup_loop, field_names, 2);
+% Protocol groups (graphLoop) are read from QueryTools/protocolGroups.csv,
+% once the paths are set up below. That file should be updated/checked periodically.
 
 %% parse inputs (verbosity, select which queries to run)
 
@@ -119,6 +111,9 @@ cd ..
 basePathDir = pwd;
 addpath([basePathDir,'/AuditVis'],[basePathDir,'/QueryTools'])
 
+%% Protocol groups -- one set of graphs per group
+graphLoop = ReadProtocolGroups([basePathDir,'/QueryTools/protocolGroups.csv']);
+
 %% 
 sprintf(' ** NOTE: You''ll be prompted to log in to MRIC %i time(s).\n', sum([doSessionQuery,doRunQuery,doUnfSessionQuery,doUnfRunQuery]));
 disp('!! Careful typing in your username and password -- you cannot use backspace');
@@ -129,34 +124,40 @@ disp(' ');
 resultsDir = [mainResultsDir,startdate,'_',enddate,'/'];
 textResultsDir = [resultsDir, 'files/'];
 
+% dates for the day stores (see flexibleQuery.py --day-store)
+storeOptions = {['--start=',startdate],['--end=',enddate]};
+
 
 if doSessionQuery
    try 
         %QUERY MRIC
         baseQueryFile = [baseQueryDir,'sessionQuery.txt'];
         try
-            [fields,data] = AuditQuery(textResultsDir, baseQueryFile, startdate, enddate);
+            AuditQuery(textResultsDir, baseQueryFile, startdate, enddate, storeOptions{:}, '--day-store=session');
         catch
             disp(' ');
             disp('The query was unsuccessful -- try again');
             %if this fails again, it will be caught by the bigger try/catch
-            [fields,data] = AuditQuery(textResultsDir, baseQueryFile, startdate, enddate); 
+            AuditQuery(textResultsDir, baseQueryFile, startdate, enddate, storeOptions{:}, '--day-store=session'); 
         end
         
-        % Add binned ages column
-        ageCol = strncmpi('Age',fields,3);
-        [fields,data] = AddBinnedAge(fields,data,ageCol);
-        % Add week start column
-        dateCol = strcmpi('Date',fields);
-        [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
-
+        % Split the results by protocol group, and graph each group from its own file
+        groupFiles = PartitionResults([textResultsDir,'Results_sessionQuery.csv'],textResultsDir,graphLoop);
         for ii=1:length(graphLoop)
             dirToSaveGraphs=[resultsDir,graphLoop(ii).dir];
             if ~exist(dirToSaveGraphs,'dir')
                 mkdir(dirToSaveGraphs)
             end
 
-            SessionAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,graphLoop(ii).protocol, 'verbose', verbose);
+            [fields,data] = ReadInQuery(groupFiles{ii});
+            % Add binned ages column
+            ageCol = strncmpi('Age',fields,3);
+            [fields,data] = AddBinnedAge(fields,data,ageCol);
+            % Add week start column
+            dateCol = strcmpi('Date',fields);
+            [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
+
+            SessionAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,{}, 'verbose', verbose);
             close all
         end
 
@@ -173,28 +174,31 @@ if doRunQuery
         baseQueryFile=[baseQueryDir,'runQuery.txt']; 
 
         try
-            [fields,data] = AuditQuery(textResultsDir, baseQueryFile, startdate, enddate);
+            AuditQuery(textResultsDir, baseQueryFile, startdate, enddate, storeOptions{:}, '--day-store=run');
         catch
             disp(' ');
             disp('The query was unsuccessful -- try again');
             %if this fails again, it will be caught by the bigger try/catch
-            [fields,data] = AuditQuery(textResultsDir, baseQueryFile, startdate, enddate);  
+            AuditQuery(textResultsDir, baseQueryFile, startdate, enddate, storeOptions{:}, '--day-store=run');  
         end
         
-        % Add binned ages column
-        ageCol = strncmpi('Age',fields,3);
-        [fields,data] = AddBinnedAge(fields,data,ageCol);
-        % Add week start column
-        dateCol = strcmpi('Date',fields);
-        [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
-
+        % Split the results by protocol group, and graph each group from its own file
+        groupFiles = PartitionResults([textResultsDir,'Results_runQuery.csv'],textResultsDir,graphLoop);
         for ii=1:length(graphLoop)
             dirToSaveGraphs=[resultsDir,graphLoop(ii).dir];
             if ~exist(dirToSaveGraphs,'dir')
                 mkdir(dirToSaveGraphs)
             end
 
-            RunAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,graphLoop(ii).protocol, 'verbose', verbose);
+            [fields,data] = ReadInQuery(groupFiles{ii});
+            % Add binned ages column
+            ageCol = strncmpi('Age',fields,3);
+            [fields,data] = AddBinnedAge(fields,data,ageCol);
+            % Add week start column
+            dateCol = strcmpi('Date',fields);
+            [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
+
+            RunAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,{}, 'verbose', verbose);
             close all
         end
 
@@ -215,30 +219,32 @@ if doUnfSessionQuery
     try
         baseQueryFile=[baseQueryDir,'sessionQuery_noFilters.txt']; 
         try
-            [fields,data] = AuditQuery(UNFtextResultsDir,baseQueryFile);
+            % entire table -- stream it to the results file (see flexibleQuery.py)
+            AuditQuery(UNFtextResultsDir,baseQueryFile,'--out-of-core');
         catch
             disp(' ');
             disp('The query was unsuccessful -- try again');
             %if this fails again, it will be caught by the bigger try/catch
-            [fields,data] = AuditQuery(UNFtextResultsDir,baseQueryFile);
+            AuditQuery(UNFtextResultsDir,baseQueryFile,'--out-of-core');
         end
         
-        % Add binned ages column
-        ageCol = strncmpi('Age',fields,3);
-        [fields,data] = AddBinnedAge(fields,data,ageCol);
-        
-        % Add week start column
-        dateCol = strcmpi('Date',fields);
-        [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
-
-
+        % Split the results by protocol group, and graph each group from its own file
+        groupFiles = PartitionResults([UNFtextResultsDir,'Results_sessionQuery_noFilters.csv'],UNFtextResultsDir,graphLoop);
         for ii=1:length(graphLoop)
             dirToSaveGraphs=[UNFresultsDir,graphLoop(ii).dir];
             if ~exist(dirToSaveGraphs,'dir')
                 mkdir(dirToSaveGraphs)
             end
 
-            SessionAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,graphLoop(ii).protocol, 'verbose', verbose);
+            [fields,data] = ReadInQuery(groupFiles{ii});
+            % Add binned ages column
+            ageCol = strncmpi('Age',fields,3);
+            [fields,data] = AddBinnedAge(fields,data,ageCol);
+            % Add week start column
+            dateCol = strcmpi('Date',fields);
+            [fields,data] = AddWeekStart(fields,data,dateCol,'Mon');
+
+            SessionAuditGraphs(dirToSaveGraphs,graphLoop(ii).title,fields,data,{}, 'verbose', verbose);
             close all
         end
         cd(origDir)
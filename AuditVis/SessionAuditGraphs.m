@@ -15,6 +15,10 @@ function SessionAuditGraphs(dirToSave,graphTitle,fields,data,protocols, varargin
 %
 % Optional
 %   'verbose'   1 or 0 -- if false, limits the number of messages printed
+%   'resultsFile'   the csv that DATA was read from. If the protocol
+%               bitmap written by the python scripts is next to it, it's
+%               used to filter by protocol (see READPROTOCOLBITS), instead
+%               of matching every row's protocols (PROTOCOLLOGIC).
 %
 %GRAPHS SAVED
 %   1a. # Successful sessions VS rounded age
@@ -80,12 +84,15 @@ assert(sum(weekStartCol)==1,'Error in SessionAuditGraphs: there must be exactly
 
 %default verbosity = true
 verbose = 1;
+resultsFile = '';
 if ~isempty(varargin)
     assert(mod(length(varargin),2)==0,'Optional inputs must be in name, value pairs (odd number of parameters passed in).');
     for i = 1:2:length(varargin)
         switch lower(varargin{i})
             case 'verbose'
                 verbose = varargin{i+1};
+            case 'resultsfile'
+                resultsFile = varargin{i+1};
             otherwise
                 warning('Unidentified parameter name: %s',varargin{i});
         end
@@ -98,7 +105,13 @@ if ~isempty(protocols)
     colNum=find(cellfun(@(x) ~isempty(strfind(x,'Protocol')),fields));
     assert(length(colNum)==1,'Error in SessionAuditGraphs: there must be exactly one "Protocol" column in fields');
     
-    [allProtocols,allProtLogic] = ProtocolLogic(data,colNum);
+    %use the protocol bitmap written next to the results file, if it's there
+    if ~isempty(resultsFile) && exist([resultsFile(1:end-4),'_protocolBits.csv'],'file')
+        [allProtocols,allProtLogic] = ReadProtocolBits(resultsFile);
+        assert(size(allProtLogic,1)==size(data,1),'Error in SessionAuditGraphs: the protocol bitmap for %s does not match DATA',resultsFile);
+    else
+        [allProtocols,allProtLogic] = ProtocolLogic(data,colNum);
+    end
     
     if ~iscell(protocols)
         protocols={protocols};
@@ -111,8 +124,8 @@ if ~isempty(protocols)
     data=data(protSelect,:);
 end
 
-%only make graphs if there is data from the selected protocols
-if sum(protSelect) == 0
+%only make graphs if there is data (from the selected protocols)
+if isempty(data)
     return
 end
 
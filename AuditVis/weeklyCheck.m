@@ -146,9 +146,13 @@ if processData
     %do a little processing
     monthAgeCol=strncmpi('Age',sessionFields,3);
     [sessionFields,sessionData] = AddBinnedAge(sessionFields,sessionData,monthAgeCol);
-    %protocol logic
-    protCol=find(cellfun(@(x) ~isempty(strfind(x,'Protocol')),sessionFields));
-    [sAllProtocols,sProtLogic] = ProtocolLogic(sessionData,protCol);
+    %protocol logic -- use the bitmap written by weeklyCheckQuery.py if it's there
+    if exist([sessionFilename(1:end-4),'_protocolBits.csv'],'file')
+        [sAllProtocols,sProtLogic] = ReadProtocolBits(sessionFilename);
+    else
+        protCol=find(cellfun(@(x) ~isempty(strfind(x,'Protocol')),sessionFields));
+        [sAllProtocols,sProtLogic] = ProtocolLogic(sessionData,protCol);
+    end
     
     %read in phase query
     [phaseFields,phaseData] = ReadInQuery(phaseFilename);
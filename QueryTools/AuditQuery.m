@@ -9,7 +9,11 @@ function [fields,data] = AuditQuery(resultsDir,baseQueryFile,varargin)
 %         for details). Can pass a full path. If full path isn't passed,
 %         looks in /Users/etl/Desktop/DataQueries/BaseQueries/
 %       varargin -- strings to fill in the gaps in the base query (see
-%         below for details)
+%         below for details). Any that start with -- are passed on to
+%         flexibleQuery.py as options instead (e.g. '--out-of-core' to
+%         stream a big, unfiltered query straight to the results file, or
+%         '--day-store=session','--start=...','--end=...' to put the results
+%         together from the day store that prefetchQuery.py fills).
 %
 % Outputs:
 %       fields (cell) -- column headers corresponding to data
@@ -51,9 +55,11 @@ function [fields,data] = AuditQuery(resultsDir,baseQueryFile,varargin)
 %   The script will produce an error if it cannot open the results file (e.g. if 
 %   there is an error in the Python script)
 %
-%   The text file is read in using READINQUERY, and the resulting variables
-%   data and fields are saved as a matfile called 
+%   flexibleQuery.py also writes the parsed results (the variables data and
+%   fields) as a matfile called 
 %       Results_[name of base query file].mat 
+%   If that file is missing, the text file is read in using READINQUERY, and
+%   the resulting variables are saved in it.
 %   Currently, the script will always reprocess results, overwriting any
 %   matfile that exists with that name.
 %
@@ -72,6 +78,11 @@ function [fields,data] = AuditQuery(resultsDir,baseQueryFile,varargin)
 %%
 origDir = pwd;
 
+% split flexibleQuery.py options (--...) from the strings for the base query
+isOption = cellfun(@(x) strncmp(x,'--',2),varargin);
+pyOptions = sprintf(' %s',varargin{isOption});
+varargin = varargin(~isOption);
+
 % DEFAULT DIRECTORIES:
 pythonDir = '/Users/etl/Desktop/GitCode/mric-audits/QueryTools/';
 
@@ -162,7 +173,7 @@ if runPython
     commandwindow();
     disp(' ')
     disp('---------flexibleQuery.py---------')
-    system(['python flexibleQuery.py ',newQueryFile,' ',resultsDir]); %MATLAB command line will display prompts for MRIC username/password
+    system(['python flexibleQuery.py',pyOptions,' ',newQueryFile,' ',resultsDir]); %MATLAB command line will display prompts for MRIC username/password
     disp('----------------------------------')
     cd(origDir)
     
@@ -0,0 +1,39 @@
+function groupFiles = PartitionResults(resultsFile,outDir,graphLoop)
+%PARTITIONRESULTS
+%
+% Splits a results csv (RESULTSFILE) into one file per protocol group by
+% calling protocolGroups.py, so that each group's graphs only have to load
+% that group's rows. GRAPHLOOP is the struct array of groups, read from
+% the same protocolGroups.csv (see READPROTOCOLGROUPS). Each group's
+% results are saved as
+%       [outDir][group dir]/[name of resultsFile]
+% along with a .mat file, protocol bitmap and row-offset index. Returns a
+% cell GROUPFILES with the name of each group's results file, in the same
+% order as GRAPHLOOP.
+%
+% protocolGroups.py must be in the same folder as this script.
+%
+% See also: ETLAUDITGRAPHS, READPROTOCOLGROUPS, READINQUERY
+
+%%
+assert(logical(exist(resultsFile,'file')),'QueryTools:fileNotFound',['Error in PartitionResults: ',resultsFile,' does not exist']);
+
+% add trailing / if it's missing
+if ~strcmpi(outDir(end),'/')
+    outDir = [outDir,'/'];
+end
+
+[~,name,ext] = fileparts(resultsFile);
+groupFiles = arrayfun(@(g) [outDir,g.dir,'/',name,ext],graphLoop,'UniformOutput',false);
+
+%% Call protocolGroups.py (it reads the groups from protocolGroups.csv too)
+pythonDir = fileparts(mfilename('fullpath'));
+[status,output] = system(['python ',pythonDir,'/protocolGroups.py ',resultsFile,' ',outDir]);
+if status~=0
+    error('QueryTools:pythonError',['Error in PartitionResults: protocolGroups.py failed:\n',output]);
+end
+
+missing = ~cellfun(@(x) logical(exist(x,'file')),groupFiles);
+if any(missing)
+    error('QueryTools:fileNotFound',['Error in PartitionResults: Cannot find results file: ',groupFiles{find(missing,1)}]);
+end
@@ -9,11 +9,18 @@ function [fields,data] = ReadInQuery(filename)
 % special cases:
 %   - If the column title contains "date", that column of data will be
 %       converted to [Y M D]. Can handle dates that are formatted in MRIC's
-%       output format (YYYY-MM-DD) or Excel's default (M(M)/D(D)/YY)
+%       output format (YYYY-MM-DD) or Excel's default (M(M)/D(D)/YY). The
+%       date columns added by derivedColumns.py (WeekStart, MonthStart and
+%       QuarterStart -- see derivedColumns.cfg) are converted the same way.
 %   - If the column title contains "array", each item in the column is placed
 %       in a cell, and split into individual entries using the delimiter
 %       ###. This corresponds to the output of the script flexibleQuery.py
 %
+% If there is a .mat file with the same name as the csv (written by
+% flexibleQuery.py or weeklyCheckQuery.py -- see matExport.py) that is at
+% least as new as the csv, fields and data are loaded from it instead of
+% parsing the csv.
+%
 % NOTE: to make this script compatible with P&T computer (ie MATLAB2012),
 %   replace strsplit with strsplit_CR
 %
@@ -29,6 +36,24 @@ if ~strcmpi(filename((end-3):end),'.csv')
    warning(['File name (',filename,') does not end with ''.csv'' - ReadInQuery may not work properly.']); 
 end
 
+% Use the parsed results written by the python scripts, if they're up to date
+matFilename = [filename(1:end-4),'.mat'];
+if exist(matFilename,'file')
+    csvInfo = dir(filename);
+    matInfo = dir(matFilename);
+    if matInfo.datenum >= csvInfo.datenum
+        parsed = load(matFilename);
+        if isfield(parsed,'fields') && isfield(parsed,'data')
+            fields = parsed.fields;
+            data = parsed.data;
+            return
+        end
+    end
+end
+
+% Derived date columns written by derivedColumns.py
+derivedDates = {'WeekStart','MonthStart','QuarterStart'};
+
 fid = fopen(filename);
 
 % Get column headers
@@ -77,7 +102,7 @@ while ischar(line)
             end
         % Process dates -- array as numbers [Y M D]
         % Works for excel and database format (M(M)/D(D)/YY or YYYY-MM-DD)
-        elseif strfind(lower(fields{colIndex}),'date')
+        elseif ~isempty(strfind(lower(fields{colIndex}),'date')) || any(strcmpi(fields{colIndex},derivedDates))
             
             if isempty(entry)
                 data{rowIndex,colIndex} = [-1 -1 -1]; %if date is missing, flag with -1s
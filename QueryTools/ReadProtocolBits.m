@@ -0,0 +1,48 @@
+function [allProtocols,protLogic] = ReadProtocolBits(filename)
+%READPROTOCOLBITS
+%
+% Reads the protocol dictionary and bitmap that the Python scripts write
+% next to a results csv (FILENAME), and returns the same outputs as
+% PROTOCOLLOGIC: ALLPROTOCOLS is a sorted cell of the unique protocols, and
+% PROTLOGIC is a logical matrix with one row per row of results and one
+% column per protocol. The matrix is built with bit operations (one
+% column at a time), so this is much faster than PROTOCOLLOGIC for big
+% results.
+%
+% The sidecar files are named after the results file:
+%       Results_X_protocols.csv     -- Protocol,Word,Bit
+%       Results_X_protocolBits.csv  -- Word1,Word2,... (one row per result)
+% See protocolBitmap.py for details.
+%
+% See also PROTOCOLLOGIC, READINQUERY
+
+%%
+base = filename(1:end-4);
+dictFile = [base,'_protocols.csv'];
+bitsFile = [base,'_protocolBits.csv'];
+assert(logical(exist(dictFile,'file')) && logical(exist(bitsFile,'file')),'QueryTools:fileNotFound',...
+    ['Error in ReadProtocolBits: cannot find the protocol files for ',filename]);
+
+fid = fopen(dictFile);
+dict = textscan(fid,'%s %f %f','Delimiter',',','HeaderLines',1);
+fclose(fid);
+allProtocols = dict{1}';
+words = dict{2};
+bits = dict{3};
+
+%csvread errors on a file with only headers (no results)
+fid = fopen(bitsFile);
+fgetl(fid);
+isEmpty = ~ischar(fgetl(fid));
+fclose(fid);
+if isEmpty
+    bitmap = zeros(0,max([words;1]));
+else
+    bitmap = csvread(bitsFile,1,0);
+end
+
+%%
+protLogic = false(size(bitmap,1),length(allProtocols));
+for i = 1:length(allProtocols)
+    protLogic(:,i) = bitget(bitmap(:,words(i)),bits(i))>0;
+end
@@ -0,0 +1,26 @@
+function graphLoop = ReadProtocolGroups(filename)
+%READPROTOCOLGROUPS
+%
+% Reads the protocol groups that audit graphs are made for from a csv
+% (FILENAME, normally QueryTools/protocolGroups.csv) with the columns dir,
+% title and protocols. Protocols are separated by ###. Returns a struct
+% array GRAPHLOOP with the fields dir, title and protocol (a cell of
+% protocols), one element per group.
+%
+% The same file is used by protocolGroups.py to split query results by
+% group.
+%
+% NOTE: to make this script compatible with MATLAB2012, replace strsplit
+%   with strsplit_CR
+%
+% See also ETLAUDITGRAPHS, SESSIONAUDITGRAPHS, RUNAUDITGRAPHS
+
+%%
+assert(logical(exist(filename,'file')),'QueryTools:fileNotFound',['Error in ReadProtocolGroups: ',filename,' does not exist']);
+
+fid = fopen(filename);
+cols = textscan(fid,'%s%s%s','Delimiter',',','Whitespace','','HeaderLines',1);
+fclose(fid);
+
+protocols = cellfun(@(x) strsplit(strtrim(x),{'###'}),cols{3},'UniformOutput',false);
+graphLoop = struct('dir',strtrim(cols{1}),'title',strtrim(cols{2}),'protocol',protocols);
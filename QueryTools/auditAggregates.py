@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+""" auditAggregates.py
+
+    Keeps daily partial aggregates of the session and run tables, so that audit
+    summaries for any rolling window (e.g. the last three months that weeklyCheck.m
+    graphs every week) can be put together from stored partials instead of being
+    recomputed from the full query results.
+
+    For each day, the store has one JSON file (AGG_PATH/YYYY-MM-DD.json) with counts
+    keyed by protocol, binned age and quality:
+        sessions    number of sessions
+        runs        number of runs, and the summed sample, fixation and lost counts
+    Sessions/runs in more than one protocol are counted under each protocol (the same
+    as filtering by protocol in MATLAB); those with no protocol are counted under ''.
+    Missing ages and qualities are counted under -1.
+
+    Updating a date range only queries the days that haven't been stored yet (or
+    that were stored before they settled and are due to be fetched again, as in
+    dayStore.py), and rewrites only those days (each in one step, holding a lock on the
+    store, so that jobs running at the same time don't get in each other's way).
+
+    Usage:
+        python auditAggregates.py update startdate enddate --> query MRIC for the
+            days in the range that aren't stored yet, and store their aggregates.
+
+        python auditAggregates.py window startdate enddate [outFile] --> sum the
+            stored aggregates for the range and print them (or write them to a csv).
+            Columns: Protocol, BinnedAge, Quality, Sessions, Runs, Sample count,
+            Fix count, Lost count.
+
+"""
+
+import os, sys
+import csv, time
+import simplejson
+from dayStore import daterange, contiguous, isFreshFetch, replacing, locked
+from derivedColumns import binAges
+from weeklyCheckQuery import fetchSessions, fetchRuns, datecheck, _login
+
+###
+AGG_PATH = '/Users/etl/Desktop/DataQueries/Aggregates/' #where daily aggregates are saved
+###
+
+HEADERS = ['Protocol','BinnedAge','Quality','Sessions','Runs','Sample count','Fix count','Lost count']
+
+def binnedAge(age):
+    """ Bin an age in months to the visit the child was probably fulfilling (bins
+    from derivedColumns.cfg, as for exported results). Missing ages are binned as -1. """
+    return int(binAges([age])[0])
+
+def aggregateKeys(row,age=None):
+    """ (protocol, binned age, quality) keys that a session/run row counts under
+    (pass in the binned age if it's already been computed) """
+    protocols = row.get('Protocol array') or ['']
+    if type(protocols)!=list:
+        protocols = [protocols]
+    quality = row.get('Quality')
+    if quality is None or quality=='':
+        quality = -1
+    if age is None:
+        age = binnedAge(row.get('Age (months)'))
+    return [(str(p),age,int(quality)) for p in sorted(set(protocols))]
+
+def count(value):
+    if value is None or value=='':
+        return 0
+    return int(value)
+
+class AggregateStore(object):
+    """ Daily partial aggregates, saved as one JSON file per day in path """
+    def __init__(self,path):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def dayFile(self,day):
+        return os.path.join(self.path,day+'.json')
+
+    def load(self,day):
+        with open(self.dayFile(day)) as f:
+            return simplejson.load(f)
+
+    def isFresh(self,day):
+        if not os.path.exists(self.dayFile(day)):
+            return False
+        return isFreshFetch(day,self.load(day)['fetched'])
+
+    def missing(self,startdate,enddate):
+        """ Contiguous (start, end) ranges of days that need to be queried """
+        return contiguous([day for day in daterange(startdate,enddate) if not self.isFresh(day)])
+
+    def update(self,startdate,enddate,sessions,runs,fetchedAt=None):
+        """ Recompute the aggregates for every day from startdate to enddate, given
+        all of the session and run rows (dicts, as returned by MRIC) for those days """
+        if fetchedAt is None:
+            fetchedAt = time.time()
+        days = dict((day,{'sessions':{},'runs':{}}) for day in daterange(startdate,enddate))
+
+        sessionAges = binAges([row.get('Age (months)') for row in sessions])
+        for (row,age) in zip(sessions,sessionAges):
+            if row['Date'] not in days:
+                continue
+            counts = days[row['Date']]['sessions']
+            for key in aggregateKeys(row,int(age)):
+                counts[key] = counts.get(key,0)+1
+        runAges = binAges([row.get('Age (months)') for row in runs])
+        for (row,age) in zip(runs,runAges):
+            if row['Date'] not in days:
+                continue
+            counts = days[row['Date']]['runs']
+            for key in aggregateKeys(row,int(age)):
+                total = counts.setdefault(key,[0,0,0,0])
+                total[0] += 1
+                total[1] += count(row.get('Sample count'))
+                total[2] += count(row.get('Fix count'))
+                total[3] += count(row.get('Lost count'))
+
+        with locked(self.path):
+            for (day,counts) in days.items():
+                if os.path.exists(self.dayFile(day)) and self.load(day)['fetched']>fetchedAt:
+                    continue #saved from a later fetch by another process
+                with replacing(self.dayFile(day)) as f:
+                    simplejson.dump({'fetched':fetchedAt,
+                                     'sessions':[list(k)+[v] for (k,v) in sorted(counts['sessions'].items())],
+                                     'runs':[list(k)+v for (k,v) in sorted(counts['runs'].items())]},f)
+
+    def window(self,startdate,enddate):
+        """ Sum the stored aggregates for a date range. Returns a dict of
+        (protocol, binned age, quality) -> [sessions, runs, samples, fix, lost] """
+        days = daterange(startdate,enddate)
+        absent = [day for day in days if not os.path.exists(self.dayFile(day))]
+        if absent:
+            raise RuntimeError("No aggregates stored for %i day(s) (%s ... %s) - run update first"
+                               % (len(absent),absent[0],absent[-1]))
+        totals = {}
+        for day in days:
+            partial = self.load(day)
+            for (protocol,age,quality,n) in partial['sessions']:
+                totals.setdefault((protocol,age,quality),[0,0,0,0,0])[0] += n
+            for (protocol,age,quality,n,samples,fix,lost) in partial['runs']:
+                total = totals.setdefault((protocol,age,quality),[0,0,0,0,0])
+                for (i,value) in enumerate((n,samples,fix,lost)):
+                    total[i+1] += value
+        return totals
+
+    def writeWindow(self,csv_writer,startdate,enddate):
+        csv_writer.writerow(HEADERS)
+        for (key,total) in sorted(self.window(startdate,enddate).items()):
+            csv_writer.writerow(list(key)+total)
+        return
+
+def updateStore(fetch,store,startdate,enddate):
+    """ Query MRIC for the days that the store is missing, and store them """
+    for (first,last) in store.missing(startdate,enddate):
+        fetchedAt = time.time()
+        sessions = fetchSessions(fetch,first,last)
+        runs = [row for chunk in fetchRuns(fetch,first,last) for row in chunk]
+        store.update(first,last,sessions,runs,fetchedAt)
+        print "Stored aggregates for %s to %s" % (first,last)
+    return
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython auditAggregates.py update startdate enddate\n\tpython auditAggregates.py window startdate enddate *outFile"
+    if len(sys.argv)<4 or sys.argv[1] not in ('update','window'):
+        sys.exit(usage)
+    for date in sys.argv[2:4]:
+        if datecheck(date):
+            sys.exit("Invalid date format: " + datecheck(date))
+
+    store = AggregateStore(AGG_PATH)
+    if sys.argv[1]=='update':
+        try:
+            fetch = _login()
+        except Exception, err:
+            print "Sorry, wrong username or password. \n more::", err
+            sys.exit(-1)
+        updateStore(fetch,store,sys.argv[2],sys.argv[3])
+    elif len(sys.argv)==5:
+        with open(sys.argv[4],'w') as f:
+            store.writeWindow(csv.writer(f),sys.argv[2],sys.argv[3])
+    else:
+        store.writeWindow(csv.writer(sys.stdout),sys.argv[2],sys.argv[3])
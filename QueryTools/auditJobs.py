@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+""" auditJobs.py
+
+    A local scheduler for audit jobs, so that date ranges and protocol groups can be
+    queued up and run in parallel instead of one script at a time.
+
+    Jobs are saved in a queue on disk (one JSON file per job in JOB_PATH/queued), so
+    they can be added while the scheduler is running, and are picked up again after
+    a restart. Any job that was running when a scheduler stopped is put back in the
+    queue when the next scheduler starts.
+
+    The scheduler runs up to WORKERS jobs at a time, each in its own process, highest
+    priority first (jobs with the same priority run in the order they were added).
+    Each job runs under a pidfile latch for its key (its type and arguments, see
+    latch in htsql_client.py), so identical jobs never run at the same time, even
+    from two schedulers. Adding a job that's already queued doesn't add it again (it
+    just keeps the higher priority). Jobs with different keys (e.g. overlapping weekly
+    ranges, or weekly and aggregates jobs) can share the day stores and the aggregates,
+    which are safe to update from several processes at once (see dayStore.py).
+
+    Each job's output goes to JOB_PATH/logs/[job id].log. When it finishes, the job
+    is moved to JOB_PATH/finished with its status and timing.
+
+    Job types:
+        weekly startdate enddate            weekly check queries (weeklyCheckQuery.py)
+        aggregates startdate enddate        update the daily aggregates (auditAggregates.py)
+        groups resultsFile outDir [dir...]  split results by protocol group (protocolGroups.py),
+                                            for all groups or only the listed group dirs
+
+    Usage:
+        python auditJobs.py add [--priority=N] jobType args... --> queue a job
+            (default priority 0; higher runs first)
+        python auditJobs.py run [--workers=N] --> log in to MRIC and run queued jobs
+            until the queue is empty, then print the time each job took
+        python auditJobs.py list --> show queued and running jobs
+        python auditJobs.py report --> show finished jobs and their timing
+
+"""
+
+import os, sys, re
+import time, getopt
+import getpass
+import multiprocessing
+import simplejson
+from sys import stdin, stdout
+from htsql_client import latch
+from weeklyCheckQuery import datecheck, _login
+import weeklyCheckQuery
+from auditAggregates import AggregateStore, updateStore, AGG_PATH
+from protocolGroups import readGroups, partition
+
+###
+JOB_PATH = '/Users/etl/Desktop/DataQueries/Jobs/' #queue, logs and pidfiles
+WORKERS = 4 #jobs run at once
+POLL = 0.5 #seconds between checks on running jobs
+###
+
+EXIT_LATCHED = 3 #exit code of a job that found an identical job already running
+
+def runWeekly(fetch,startdate,enddate):
+    weeklyCheckQuery.main(fetch,[startdate,enddate])
+
+def runAggregates(fetch,startdate,enddate):
+    updateStore(fetch,AggregateStore(AGG_PATH),startdate,enddate)
+
+def runGroups(fetch,resultFile,outDir,*groupDirs):
+    groups = readGroups()
+    if groupDirs:
+        groups = [g for g in groups if g['dir'] in groupDirs]
+        if len(groups)!=len(set(groupDirs)):
+            raise RuntimeError("Unknown protocol group(s): "+', '.join(set(groupDirs)-set(g['dir'] for g in groups)))
+    partition(resultFile,outDir,groups)
+
+# job type -> (function, number of required args, whether it needs to log in)
+JOBS = {'weekly':(runWeekly,2,True),
+        'aggregates':(runAggregates,2,True),
+        'groups':(runGroups,2,False)}
+
+def checkJob(kind,args):
+    """ Return None if a job's type and args are valid, or a string explaining why not """
+    if kind not in JOBS:
+        return "Unknown job type: "+kind
+    (function,nargs,needsLogin) = JOBS[kind]
+    if len(args)<nargs or (kind!='groups' and len(args)>nargs):
+        return "Wrong number of arguments for a "+kind+" job"
+    if kind in ('weekly','aggregates'):
+        for date in args:
+            if datecheck(date):
+                return "Invalid date format: "+datecheck(date)
+    return None
+
+def jobKey(kind,args):
+    """ Key that identical jobs share (used for the latch and for duplicates) """
+    return re.sub(r'[^\w.-]+','-','_'.join([kind]+list(args)))
+
+def pidAlive(pid):
+    try:
+        os.kill(pid,0)
+    except OSError:
+        return False
+    return True
+
+class JobQueue(object):
+    """ Audit jobs saved as JSON files in path/queued, path/running and
+    path/finished (running jobs are named [id].[scheduler pid].json) """
+    def __init__(self,path):
+        self.path = path
+        for subdir in ('queued','running','finished','logs','locks'):
+            if not os.path.exists(os.path.join(path,subdir)):
+                os.makedirs(os.path.join(path,subdir))
+
+    def jobFile(self,state,name):
+        return os.path.join(self.path,state,name)
+
+    def load(self,state):
+        jobs = []
+        for name in os.listdir(os.path.join(self.path,state)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(self.jobFile(state,name)) as f:
+                    job = simplejson.load(f)
+            except (IOError,ValueError):
+                continue #moved or half-written by another scheduler
+            job['file'] = name
+            jobs.append(job)
+        return jobs
+
+    def save(self,state,name,job):
+        """ Write a job file (via a temporary file, so it's never half-written) """
+        job = dict((k,v) for (k,v) in job.items() if k!='file')
+        temp = self.jobFile(state,'.'+name+'.tmp')
+        with open(temp,'w') as f:
+            simplejson.dump(job,f)
+        os.rename(temp,self.jobFile(state,name))
+
+    def queued(self):
+        """ Queued jobs, in the order they should run """
+        return sorted(self.load('queued'),key=lambda job: (-job['priority'],job['submitted'],job['id']))
+
+    def running(self):
+        return self.load('running')
+
+    def finished(self):
+        return sorted(self.load('finished'),key=lambda job: job['finished'])
+
+    def add(self,kind,args,priority=0):
+        """ Queue a job, returning its id. If an identical job is already queued,
+        keep that one (with the higher of the two priorities). """
+        problem = checkJob(kind,args)
+        if problem:
+            raise RuntimeError(problem)
+        key = jobKey(kind,args)
+        for job in self.queued():
+            if job['key']==key:
+                if priority>job['priority']:
+                    job['priority'] = priority
+                    self.save('queued',job['file'],job)
+                return job['id']
+        submitted = time.time()
+        jobId = '%s%03i_%i_%s' % (time.strftime('%Y%m%d-%H%M%S',time.localtime(submitted)),
+                                  int(submitted*1000)%1000,os.getpid(),key)
+        self.save('queued',jobId+'.json',{'id':jobId,'kind':kind,'args':list(args),'key':key,
+                                          'priority':priority,'submitted':submitted})
+        return jobId
+
+    def claim(self,job):
+        """ Move a queued job to running. Returns the running job, or None if another
+        scheduler got to it first. """
+        name = '%s.%i.json' % (job['id'],os.getpid())
+        try:
+            os.rename(self.jobFile('queued',job['file']),self.jobFile('running',name))
+        except OSError:
+            return None
+        job['file'] = name
+        return job
+
+    def finish(self,job):
+        os.remove(self.jobFile('running',job['file']))
+        self.save('finished',job['id']+'.json',job)
+
+    def resume(self):
+        """ Put jobs left running by schedulers that have stopped back in the
+        queue. Returns the number of jobs requeued. """
+        count = 0
+        for job in self.running():
+            owner = int(job['file'].split('.')[-2])
+            if owner==os.getpid() or pidAlive(owner):
+                continue
+            try:
+                os.rename(self.jobFile('running',job['file']),self.jobFile('queued',job['id']+'.json'))
+            except OSError:
+                continue
+            count += 1
+        return count
+
+    def logFile(self,job):
+        return os.path.join(self.path,'logs',job['id']+'.log')
+
+    def lockFile(self,job):
+        return os.path.join(self.path,'locks',job['key']+'.pid')
+
+def runJob(job,logFile,lockFile,credentials):
+    """ Run one job (in its own process), under the latch for its key """
+    log = open(logFile,'a',0)
+    sys.stdout = sys.stderr = log
+    print "%s: %s %s" % (time.strftime('%Y-%m-%d %H:%M:%S'),job['kind'],' '.join(job['args']))
+
+    ran = []
+    def main():
+        ran.append(True)
+        (function,nargs,needsLogin) = JOBS[job['kind']]
+        fetch = _login(*credentials) if needsLogin else None
+        function(fetch,*job['args'])
+    latch(main,lockFile,job['key'])
+    if not ran:
+        sys.exit(EXIT_LATCHED)
+
+def schedule(queue,workers=WORKERS,credentials=(None,None)):
+    """ Run queued jobs, up to workers at a time, until the queue is empty. Returns
+    the finished jobs. """
+    resumed = queue.resume()
+    if resumed:
+        print "Resuming %i interrupted job(s)" % resumed
+    running = {} #key -> (process, job)
+    done = []
+    while True:
+        for (key,(process,job)) in running.items():
+            if process.is_alive():
+                continue
+            process.join()
+            job['finished'] = time.time()
+            job['elapsed'] = job['finished']-job['started']
+            job['exitcode'] = process.exitcode
+            job['status'] = {0:'done',EXIT_LATCHED:'skipped'}.get(process.exitcode,'failed')
+            queue.finish(job)
+            done.append(job)
+            del running[key]
+            print "%-8s %7.1f s  %s" % (job['status'],job['elapsed'],job['id'])
+
+        queued = queue.queued()
+        for job in queued:
+            if len(running)>=workers:
+                break
+            if job['key'] in running or not queue.claim(job):
+                continue
+            job['started'] = time.time()
+            job['log'] = queue.logFile(job)
+            process = multiprocessing.Process(target=runJob,name=job['key'],
+                                              args=(job,job['log'],queue.lockFile(job),credentials))
+            process.start()
+            job['pid'] = process.pid
+            queue.save('running',job['file'],job)
+            running[job['key']] = (process,job)
+            print "started  %s" % job['id']
+
+        if not running and not queued:
+            break
+        time.sleep(POLL)
+    return done
+
+def report(jobs,out=stdout):
+    """ Print the status and timing of finished jobs """
+    out.write("%-8s %-19s %10s %9s  %s\n" % ('Status','Started','Waited (s)','Ran (s)','Job'))
+    for job in jobs:
+        out.write("%-8s %-19s %10.1f %9.1f  %s %s\n" % (job['status'],
+            time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(job['started'])),
+            job['started']-job['submitted'],job['elapsed'],job['kind'],' '.join(job['args'])))
+    return
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython auditJobs.py add [--priority=N] jobType args...\n\tpython auditJobs.py run [--workers=N]\n\tpython auditJobs.py list\n\tpython auditJobs.py report"
+    if len(sys.argv)<2 or sys.argv[1] not in ('add','run','list','report'):
+        sys.exit(usage)
+    try:
+        (opts,args) = getopt.getopt(sys.argv[2:],'',['priority=','workers='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err)+"\n"+usage)
+    opts = dict(opts)
+    queue = JobQueue(JOB_PATH)
+
+    if sys.argv[1]=='add':
+        if not args:
+            sys.exit(usage)
+        problem = checkJob(args[0],args[1:])
+        if problem:
+            sys.exit(problem+"\n"+usage)
+        print "Queued "+queue.add(args[0],args[1:],int(opts.get('--priority',0)))
+    elif sys.argv[1]=='run':
+        print "**Log in to MRIC**"
+        stdout.write("Username: ")
+        u = stdin.readline().strip()
+        p = getpass.getpass("Password: ").strip()
+        try:
+            _login(u,p)
+        except Exception, err:
+            print "Sorry, wrong username or password. \n more::", err
+            sys.exit(-1)
+        finished = schedule(queue,int(opts.get('--workers',WORKERS)),(u,p))
+        print " "
+        report(finished)
+    elif sys.argv[1]=='list':
+        for job in queue.running():
+            print "running  %s (pid %s)" % (job['id'],job.get('pid'))
+        for job in queue.queued():
+            print "queued   %s (priority %i)" % (job['id'],job['priority'])
+    else:
+        report(queue.finished())
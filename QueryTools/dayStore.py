@@ -0,0 +1,195 @@
+#!/usr/bin/python
+
+""" dayStore.py
+
+    Day-partitioned cache for query results that are filtered by date (e.g. the
+    session query in weeklyCheckQuery.py).
+
+    Each kind of result is kept in its own subdirectory of the store, with one csv
+    per day (named YYYY-MM-DD.csv, with the same headers and formatting as the
+    final results file) and a fetched.json file recording when each day was
+    downloaded:
+
+        STORE_PATH/session/2014-08-01.csv
+        STORE_PATH/session/fetched.json
+
+    A day is only reused if it was fetched after the day was over - days that were
+    still in progress (e.g. today) are fetched again next time. Results keep changing
+    for a while after the day itself (e.g. session quality and number of clips are
+    edited later), so a day fetched less than SETTLE_DAYS after it was over is only
+    reused for MAX_AGE seconds after it was fetched; after that it's fetched again,
+    until it's been fetched once it has settled. MAX_AGE is long enough for results
+    prefetched overnight (see prefetchQuery.py) to be reused all the next day. A
+    shorter maxAge can be passed to missing() to refresh recent days more often (the
+    prefetch itself does this, so that each night's prefetch fetches them again).
+
+    Any date range can then be assembled from the day files, and only the missing days
+    need to be queried. Missing days are grouped into contiguous ranges, so a cold start
+    still runs a single query per range.
+
+    Several processes can share a store (e.g. prefetchQuery.py and weekly jobs run by
+    auditJobs.py): files are replaced in one step rather than rewritten in place, and
+    updates hold a lock on the store.
+
+"""
+
+import os
+import csv, datetime, time
+import tempfile, fcntl
+from contextlib import contextmanager
+import simplejson
+from derivedColumns import DerivedColumns
+
+###
+SETTLE_DAYS = 28 #days after which results for a day aren't expected to change
+MAX_AGE = 36*60*60 #seconds that days fetched before they settled are reused for
+###
+
+def daterange(startdate,enddate):
+    """ List every day from startdate to enddate (inclusive) as YYYY-MM-DD """
+    start = datetime.datetime.strptime(startdate,'%Y-%m-%d').date()
+    end = datetime.datetime.strptime(enddate,'%Y-%m-%d').date()
+    return [(start+datetime.timedelta(days=n)).isoformat() for n in xrange((end-start).days+1)]
+
+def contiguous(days):
+    """ Group a sorted list of YYYY-MM-DD days into (first, last) ranges """
+    ranges = []
+    for day in days:
+        if ranges and daterange(ranges[-1][1],day)[1:] == [day]:
+            ranges[-1] = (ranges[-1][0],day)
+        else:
+            ranges.append((day,day))
+    return ranges
+
+def fetchedAfterDay(day,fetchedAt,days=0):
+    """ True if a timestamp (seconds since the epoch) is after the end of the day
+    (or at least days days after it) """
+    dayOver = datetime.datetime.strptime(day,'%Y-%m-%d')+datetime.timedelta(days=1+days)
+    return fetchedAt >= time.mktime(dayOver.timetuple())
+
+def isFreshFetch(day,fetchedAt,settleDays=SETTLE_DAYS,maxAge=MAX_AGE,now=None):
+    """ True if a day fetched at fetchedAt can be reused (see above) """
+    if not fetchedAfterDay(day,fetchedAt):
+        return False
+    if fetchedAfterDay(day,fetchedAt,settleDays):
+        return True
+    if now is None:
+        now = time.time()
+    return now-fetchedAt < maxAge
+
+@contextmanager
+def replacing(filename):
+    """ Open a temporary file to write filename through. Once it's been written, it
+    replaces filename in one step, so readers never see a half-written file. """
+    (fd,temp) = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',prefix='.tmp')
+    try:
+        with os.fdopen(fd,'w') as f:
+            yield f
+        os.rename(temp,filename)
+    except:
+        os.remove(temp)
+        raise
+
+@contextmanager
+def locked(path):
+    """ Hold an exclusive lock on a store directory (path/.lock), so that updates from
+    different processes don't overwrite each other """
+    with open(os.path.join(path,'.lock'),'a') as f:
+        fcntl.flock(f,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f,fcntl.LOCK_UN)
+
+class DayStore(object):
+    """ One kind of query result (e.g. "session"), partitioned by day.
+
+        path        directory for this kind of result (created if needed)
+        keyOrder    column headers, in the order they are written out
+    """
+    def __init__(self,path,keyOrder):
+        self.path = path
+        self.keyOrder = keyOrder
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.fetchedFile = os.path.join(self.path,'fetched.json')
+        self.load()
+
+    def load(self):
+        """ (Re)read the fetch times, which other processes may have updated """
+        self.fetched = {}
+        if os.path.exists(self.fetchedFile):
+            with open(self.fetchedFile) as f:
+                self.fetched = simplejson.load(f)
+
+    def dayFile(self,day):
+        return os.path.join(self.path,day+'.csv')
+
+    def isFresh(self,day,maxAge=MAX_AGE):
+        """ True if the day can be reused (see isFreshFetch) """
+        if day not in self.fetched or not os.path.exists(self.dayFile(day)):
+            return False
+        return isFreshFetch(day,self.fetched[day],maxAge=maxAge)
+
+    def missing(self,startdate,enddate,maxAge=MAX_AGE):
+        """ Contiguous (start, end) ranges of days that need to be queried """
+        self.load()
+        return contiguous([day for day in daterange(startdate,enddate) if not self.isFresh(day,maxAge)])
+
+    def update(self,startdate,enddate,rowsByDay,fetchedAt=None):
+        """ Save formatted rows (lists, in keyOrder) for every day from startdate to
+        enddate. Days without an entry in rowsByDay are saved as empty results. Days
+        that another process has saved from a later fetch are left alone. """
+        if fetchedAt is None:
+            fetchedAt = time.time()
+        with locked(self.path):
+            self.load()
+            for day in daterange(startdate,enddate):
+                if self.fetched.get(day,0)>fetchedAt and os.path.exists(self.dayFile(day)):
+                    continue
+                with replacing(self.dayFile(day)) as f:
+                    f_csv = csv.writer(f)
+                    f_csv.writerow(self.keyOrder)
+                    for row in rowsByDay.get(day,[]):
+                        f_csv.writerow(row)
+                self.fetched[day] = fetchedAt
+            with replacing(self.fetchedFile) as f:
+                simplejson.dump(self.fetched,f,indent=1,sort_keys=True)
+
+    def rows(self,startdate,enddate):
+        """ Read the rows saved for a date range, in day order """
+        for day in daterange(startdate,enddate):
+            with open(self.dayFile(day)) as f:
+                f_csv = csv.reader(f)
+                f_csv.next() #headers
+                for row in f_csv:
+                    yield row
+
+    def assemble(self,filename,startdate,enddate,derived=False,dedupe=False,sortKey=None):
+        """ Write out the results for a date range (headers included). If derived is
+        set, derived columns are added (see derivedColumns.py). If dedupe is set, rows
+        saved under more than one day are written once; if sortKey is set, rows are
+        (stably) sorted by that column. """
+        rows = self.rows(startdate,enddate)
+        if dedupe:
+            seen = set()
+            unique = []
+            for row in rows:
+                if tuple(row) not in seen:
+                    seen.add(tuple(row))
+                    unique.append(row)
+            rows = unique
+        if sortKey:
+            col = self.keyOrder.index(sortKey)
+            rows = sorted(rows,key=lambda row: row[col])
+
+        with open(filename,'w') as f:
+            f_csv = csv.writer(f)
+            if derived:
+                f_csv = DerivedColumns(f_csv)
+            f_csv.writerow(self.keyOrder)
+            for row in rows:
+                f_csv.writerow(row)
+            if derived:
+                f_csv.flush()
+        return
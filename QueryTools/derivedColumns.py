@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+""" derivedColumns.py
+
+    Adds derived columns to results as they're exported, so that MATLAB doesn't
+    have to recompute them every time the results are loaded:
+
+        BinnedAge       age binned to the visit the child was probably fulfilling
+                        (as in AddBinnedAge.m; -1 if the age is missing)
+        WeekStart       first day of the week the date falls in (as in AddWeekStart.m)
+        MonthStart,     first day of the date bin the date falls in (see [DateBins]
+        QuarterStart    in the config file; similar to BinDates.m)
+    Dates are written as YYYY-MM-DD ('' if the date is missing or can't be read, which
+    ReadInQuery.m turns into [-1 -1 -1]). Ages come from the first column whose name
+    starts with "Age", and dates from the column called "Date" (the same columns that
+    ETLAuditGraphs.m passes to AddBinnedAge and AddWeekStart). Columns that the
+    results already have, or that can't be computed, are not added.
+
+    Bin edges, the first day of the week and the date bins are read from a config
+    file (derivedColumns.cfg, next to this script, by default).
+
+    DerivedColumns wraps a csv writer: rows are buffered and the derived columns are
+    computed for each chunk of rows at once with NumPy, then the rows are written
+    with the new columns at the end. AddBinnedAge.m and AddWeekStart.m leave results
+    that already have BinnedAge/WeekStart columns alone.
+
+        f_csv = DerivedColumns(csv.writer(f))
+        f_csv.writerow(headers)
+        f_csv.writerows(rows)
+        f_csv.flush()       #write out the last chunk
+
+    Usage:
+        python derivedColumns.py resultsFile outFile --> copy a results csv, adding
+            the derived columns
+
+"""
+
+import os, sys
+import csv
+import ConfigParser
+import numpy as np
+from querySchema import isMissing, isoDate
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'derivedColumns.cfg')
+CHUNK = 5000 #rows computed at a time
+
+DAYS = ['mon','tue','wed','thu','fri','sat','sun']
+
+_configs = {}
+
+def readConfig(configFile=CONFIG_FILE):
+    """ Read the bin settings, returning a dict (cached by file name) """
+    if configFile in _configs:
+        return _configs[configFile]
+    parser = ConfigParser.SafeConfigParser()
+    parser.optionxform = str #keep the case of column names
+    if not parser.read(configFile):
+        raise RuntimeError("Can't read config file "+configFile)
+    ints = lambda text: [int(x) for x in text.split(',') if x.strip()]
+    config = {'edges':ints(parser.get('BinnedAge','edges')),
+              'bins':ints(parser.get('BinnedAge','bins')),
+              'exact':dict(tuple(int(v) for v in pair.split(':'))
+                           for pair in parser.get('BinnedAge','exact').split(',') if pair.strip()),
+              'above':parser.getint('BinnedAge','above'),
+              'startDay':parser.get('WeekStart','startDay').strip().lower()[:3],
+              'firstMonth':parser.getint('DateBins','firstMonth'),
+              'dateBins':[(name,int(value)) for (name,value) in parser.items('DateBins')
+                          if name!='firstMonth']}
+    if len(config['bins'])!=len(config['edges'])-1:
+        raise RuntimeError("BinnedAge needs one more edge than bins in "+configFile)
+    if config['startDay'] not in DAYS:
+        raise RuntimeError("Unknown startDay in "+configFile)
+    _configs[configFile] = config
+    return config
+
+def dateColumns(config=None):
+    """ Names of the derived columns that hold dates """
+    if config is None:
+        config = readConfig()
+    return ['WeekStart']+[name for (name,months) in config['dateBins']]
+
+def roundHalfAway(values):
+    """ Round like MATLAB (halves away from zero) """
+    return np.sign(values)*np.floor(np.abs(values)+0.5)
+
+def toFloats(values):
+    """ Float array of values, with NaN for anything missing or not a number """
+    floats = np.empty(len(values))
+    for (i,value) in enumerate(values):
+        try:
+            floats[i] = np.nan if isMissing(value) else float(value)
+        except (TypeError,ValueError):
+            floats[i] = np.nan
+    return floats
+
+def binAges(ages,config=None):
+    """ Int array of binned ages for a list of ages in months (-1 if missing) """
+    if config is None:
+        config = readConfig()
+    ages = roundHalfAway(toFloats(ages))
+    binned = ages.copy()
+    with np.errstate(invalid='ignore'): #missing ages (NaN) aren't in any bin
+        for (age,binnedAge) in config['exact'].items():
+            binned[ages==age] = binnedAge
+        edges = config['edges']
+        for (low,high,binnedAge) in zip(edges[:-1],edges[1:],config['bins']):
+            binned[(ages>low)&(ages<=high)] = binnedAge
+        above = ages>edges[-1]
+    binned[above] = roundHalfAway(ages[above]/config['above'])*config['above']
+    binned[np.isnan(binned)] = -1
+    return binned.astype(int)
+
+def toDates(values):
+    """ datetime64[D] array of dates (NaT if missing or unreadable) """
+    return np.array([('NaT' if isMissing(v) else (isoDate(v) or 'NaT')) for v in values],
+                    dtype='datetime64[D]')
+
+def isNaT(dates):
+    return dates.astype(np.int64)==np.iinfo(np.int64).min
+
+def weekStarts(dates,config=None):
+    """ First day of the week for each date in a datetime64[D] array """
+    if config is None:
+        config = readConfig()
+    days = dates.astype(np.int64)
+    # 1970-01-01 was a Thursday (3 days after a Monday)
+    offset = (days+3-DAYS.index(config['startDay']))%7
+    starts = dates-offset.astype('timedelta64[D]')
+    starts[isNaT(dates)] = np.datetime64('NaT')
+    return starts
+
+def dateBins(dates,months,config=None):
+    """ First day of the bin of months months for each date in a datetime64[D]
+    array, counting bins from firstMonth """
+    if config is None:
+        config = readConfig()
+    monthIndex = dates.astype('datetime64[M]').astype(np.int64)
+    monthIndex -= (monthIndex-(config['firstMonth']-1))%months
+    starts = monthIndex.astype('datetime64[M]').astype('datetime64[D]')
+    starts[isNaT(dates)] = np.datetime64('NaT')
+    return starts
+
+def formatDates(dates):
+    """ List of YYYY-MM-DD strings ('' for NaT) """
+    missing = isNaT(dates)
+    return ['' if m else str(d) for (d,m) in zip(dates,missing)]
+
+class DerivedColumns(object):
+    """ csv writer wrapper that adds derived columns (see above). The first row
+    written is the header. Call flush() after the last row. """
+    def __init__(self,csv_writer,config=None,chunk=CHUNK):
+        self.writer = csv_writer
+        self.config = config or readConfig()
+        self.chunk = chunk
+        self.headers = None
+        self.rows = []
+
+    def writerow(self,row):
+        if self.headers is None:
+            self.setHeaders(list(row))
+            self.writer.writerow(self.headers+self.derived)
+            return
+        self.rows.append(list(row))
+        if len(self.rows)>=self.chunk:
+            self.flush()
+
+    def writerows(self,rows):
+        for row in rows:
+            self.writerow(row)
+
+    def setHeaders(self,headers):
+        self.headers = headers
+        lower = [h.lower() for h in headers]
+        self.ageCol = ([i for (i,h) in enumerate(lower) if h.startswith('age')] or [None])[0]
+        self.dateCol = lower.index('date') if 'date' in lower else None
+        derived = []
+        if self.ageCol is not None:
+            derived.append('BinnedAge')
+        if self.dateCol is not None:
+            derived.append('WeekStart')
+            derived.extend(name for (name,months) in self.config['dateBins'])
+        self.derived = [name for name in derived if name.lower() not in lower]
+
+    def flush(self):
+        """ Compute the derived columns for the buffered rows and write them out """
+        if not self.rows:
+            return
+        columns = {}
+        if self.ageCol is not None:
+            columns['BinnedAge'] = binAges([row[self.ageCol] for row in self.rows],self.config)
+        if self.dateCol is not None:
+            dates = toDates([row[self.dateCol] for row in self.rows])
+            columns['WeekStart'] = formatDates(weekStarts(dates,self.config))
+            for (name,months) in self.config['dateBins']:
+                columns[name] = formatDates(dateBins(dates,months,self.config))
+        for (i,row) in enumerate(self.rows):
+            self.writer.writerow(row+[columns[name][i] for name in self.derived])
+        self.rows = []
+
+def addDerivedColumns(resultFile,outFile,config=None):
+    """ Copy a results csv, adding the derived columns """
+    with open(resultFile) as f:
+        with open(outFile,'w') as out:
+            f_csv = DerivedColumns(csv.writer(out),config)
+            f_csv.writerows(csv.reader(f))
+            f_csv.flush()
+
+if '__main__' == __name__:
+    if len(sys.argv)!=3:
+        sys.exit("Usage:\n\tpython derivedColumns.py resultsFile outFile")
+    addDerivedColumns(sys.argv[1],sys.argv[2])
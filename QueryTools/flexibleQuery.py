@@ -9,7 +9,13 @@ flexibleQuery.py
 
     If MRIC is returning an array, include the word "array" in the title of that
     column. This script will write out the column with ### as a delimiter between
-    items (which allows MATLAB to parse the csv properly)
+    items (which allows MATLAB to parse the csv properly). If there is a protocol
+    array column, a protocol dictionary and bitmap are written alongside the results
+    (see protocolBitmap.py). A row-offset index is also written next to the csv, so
+    that rows can be read without loading the whole file (see resultReader.py), and
+    a .mat file with the results already parsed the way ReadInQuery.m would (see
+    matExport.py). BinnedAge, WeekStart and date bin columns are added to the results
+    as they're written, if there are age and date columns (see derivedColumns.py).
 
 
     Usage: 
@@ -20,6 +26,27 @@ flexibleQuery.py
         python flexibleQuery.py queryFile --> same as above, but result csv is saved
             in the same directory as the query file.
 
+    Options (before the query file):
+        --out-of-core       stream rows from the server straight to the csv instead
+                            of loading the whole result (for big, unfiltered queries;
+                            ETLAuditGraphs.m passes this through AuditQuery.m for the
+                            entire session table)
+        --sort=col1,col2    with --out-of-core, sort rows by these columns. Rows are
+                            sorted in runs that are spilled to temporary files and
+                            merged while writing out the csv.
+        --max-memory=512M   with --sort, how much row data to keep in memory before
+                            spilling a run (default 256M)
+        --day-store=session --start=YYYY-MM-DD --end=YYYY-MM-DD
+                            build the results from the session (or run) day store
+                            in weeklyCheckQuery.py instead, only querying the days
+                            from start to end that aren't cached or are out of date
+                            (see dayStore.py). prefetchQuery.py fills the stores
+                            overnight. The query file is still saved with the
+                            results, but the store's own query is run, so it should
+                            be the matching session/run base query (ETLAuditGraphs.m
+                            passes this through AuditQuery.m for the date-filtered
+                            session and run queries)
+
     ***************
     
     Carolyn Ranti, 8.25.2014. Adapted from dataquery.py (V5.1)
@@ -29,8 +56,15 @@ import os, sys
 from sys import stdin, stdout
 from time import sleep
 from htsql_client import login
+from protocolBitmap import writeProtocolBitmap
+from resultReader import writeIndex
+from matExport import writeMat
+from derivedColumns import DerivedColumns
 import getpass
 import csv
+import getopt
+from streamingExport import iterJSONArray, ExternalSorter, parseMemory
+from weeklyCheckQuery import openStore, sessionTableQuery, runTableQuery, datecheck
 
 def _login(u=None, p=None, perspective='full_access'):
     """Log into the HTSQL server"""
@@ -59,40 +93,81 @@ def runQuery(HTSQLquery,fetch=None):
     
     return fetch(HTSQLquery)
 
-def writeOutQuery(csv_writer,queryResult):
-    """Write out query (columns are printed in random order)"""
-    
-    #exclude the 3 odd htsql: things that are output 
-    keyOrder=[k for k in queryResult[0].keys() if k.count('htsql:')==0]
-    keymap=dict(zip(keyOrder,range(1,len(keyOrder)+1)))
-
-    # fix array output so that MATLAB can handle it easily
-    for arrayCol in (k for k in keyOrder if k.count('array')>0): 
-        for row in queryResult:
-            temp = row[arrayCol]
-            if type(temp)==list:
-                temp = [str(t) for t in temp]
+def getKeyOrder(row):
+    """Columns to write out (excludes the 3 odd htsql: things that are output)"""
+    return [k for k in row.keys() if k.count('htsql:')==0]
+
+def formatRow(row,keyOrder):
+    """Return the values of a row in keyOrder, formatted for MATLAB"""
+    values = []
+    for key in keyOrder:
+        value = row[key]
+        # fix array output so that MATLAB can handle it easily
+        if key.count('array')>0:
+            if type(value)==list:
+                value = [str(t) for t in value]
             else:
-                temp = [str(temp)]
-            row[arrayCol] = '['+"###".join(temp)+']'
+                value = [str(value)]
+            value = '['+"###".join(value)+']'
+        # Catches a specific error (separating initials with a comma)
+        elif key=='Fellows' and value:
+            value = value.replace(',','&')
+        values.append(value)
+    return values
 
-    # Catches a specific error (separating initials with a comma)
-    if 'Fellows' in keyOrder:
-        for row in queryResult:
-            if row['Fellows']:
-                row['Fellows']=row['Fellows'].replace(',','&')
+def writeOutQuery(csv_writer,queryResult):
+    """Write out query (columns are printed in random order)"""
+    keyOrder=getKeyOrder(queryResult[0])
 
     #write to file
     csv_writer.writerow(keyOrder) #headers
     for row in queryResult:
-        ordered_values = [row[key] for key in keyOrder]
-        csv_writer.writerow(ordered_values)
+        csv_writer.writerow(formatRow(row,keyOrder))
 
     return
 
+def streamOutQuery(csv_writer,response,sortKeys=None,maxMemory=256*1024**2):
+    """Write out query results as they are read from the server response, without
+    holding them all in memory. If sortKeys are given, rows are sorted by those
+    columns with an external merge sort (see streamingExport.py). Returns the number
+    of rows (nothing is written if the response is None, i.e. there were no results)."""
+    keyOrder = None
+    sorter = None
+    nrows = 0
+    if response is None:
+        return nrows
+    try:
+        for (row,size) in iterJSONArray(response):
+            if keyOrder is None:
+                keyOrder = getKeyOrder(row)
+                csv_writer.writerow(keyOrder) #headers
+                if sortKeys:
+                    missing = [k for k in sortKeys if k not in keyOrder]
+                    if missing:
+                        raise RuntimeError("Can't sort by missing column(s): "+', '.join(missing))
+                    sorter = ExternalSorter(maxMemory)
+            if sorter:
+                sorter.add(tuple(row[k] for k in sortKeys),formatRow(row,keyOrder),size)
+            else:
+                csv_writer.writerow(formatRow(row,keyOrder))
+            nrows += 1
+
+        if sorter:
+            for values in sorter.merged():
+                csv_writer.writerow(values)
+    finally:
+        if sorter:
+            sorter.cleanup()
+
+    return nrows
+
+
+storeQueries = {'session':sessionTableQuery,'run':runTableQuery}
 
-def main(fullQueryFile=None,resultDir=None):
-    """ Run MRIC query and write out results to a csv. """
+def main(fullQueryFile=None,resultDir=None,outOfCore=False,sortKeys=None,maxMemory=256*1024**2,
+         storeKind=None,startdate=None,enddate=None):
+    """ Run MRIC query and write out results to a csv. If storeKind is set, the
+    results for startdate to enddate are put together from that day store instead. """
 
     try:        
         fetch = _login()
@@ -109,10 +184,14 @@ def main(fullQueryFile=None,resultDir=None):
 
     #run query
     print " "
-    print "Querying MRIC:"
-    print "    " + HTSQLquery
+    if storeKind:
+        print "Querying MRIC for the %s results from %s to %s that aren't stored yet" % (storeKind,startdate,enddate)
+    else:
+        print "Querying MRIC:"
+        print "    " + HTSQLquery
     print " "
-    queryResult = runQuery(HTSQLquery,fetch)
+    if not outOfCore and not storeKind:
+        queryResult = runQuery(HTSQLquery,fetch)
 
     # If no resultDir passed in, save the results where the query came from
     if not resultDir:
@@ -123,9 +202,20 @@ def main(fullQueryFile=None,resultDir=None):
 
     # Write out result to csv
     resultFile = resultDir+'Results_'+queryFileName+'.csv'
-    with open(resultFile,'w') as f:
-        f_csv = csv.writer(f)
-        writeOutQuery(f_csv,queryResult)
+    if storeKind:
+        storeQueries[storeKind](fetch,resultFile,startdate,enddate,openStore(storeKind))
+    else:
+        with open(resultFile,'w') as f:
+            f_csv = DerivedColumns(csv.writer(f))
+            if outOfCore:
+                # stream() records and times the query like fetch() does
+                fetch.stream(HTSQLquery,lambda response: streamOutQuery(f_csv,response,sortKeys,maxMemory))
+            else:
+                writeOutQuery(f_csv,queryResult)
+            f_csv.flush()
+    writeProtocolBitmap(resultFile)
+    writeIndex(resultFile)
+    writeMat(resultFile)
 
     print " "
     print "Done. Query results saved: "
@@ -135,11 +225,46 @@ def main(fullQueryFile=None,resultDir=None):
     return
 
 if '__main__' == __name__:
-    if len(sys.argv)==1:
-        sys.exit("Not enough arguments. Usage:\n\tpython flexibleQuery.py queryFile *resultsDir")
-    elif len(sys.argv)==2: #1 argument = queryFile
-        main(sys.argv[1])
-    elif len(sys.argv)==3: #2 arguments = queryFile, resultDir 
-        main(sys.argv[1],sys.argv[2])
+    usage = "Usage:\n\tpython flexibleQuery.py [--out-of-core [--sort=col1,col2] [--max-memory=256M]] queryFile *resultsDir"+\
+        "\n\tpython flexibleQuery.py --day-store=session|run --start=YYYY-MM-DD --end=YYYY-MM-DD queryFile *resultsDir"
+    try:
+        (opts,args) = getopt.getopt(sys.argv[1:],'',['out-of-core','sort=','max-memory=','day-store=','start=','end='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err)+"\n"+usage)
+    options = {}
+    for (opt,value) in opts:
+        if opt=='--out-of-core':
+            options['outOfCore'] = True
+        elif opt=='--sort':
+            options['sortKeys'] = [k.strip() for k in value.split(',') if k.strip()]
+        elif opt=='--max-memory':
+            options['maxMemory'] = parseMemory(value)
+        elif opt=='--day-store':
+            options['storeKind'] = value
+        elif opt=='--start':
+            options['startdate'] = value
+        elif opt=='--end':
+            options['enddate'] = value
+    if ('sortKeys' in options or 'maxMemory' in options) and not options.get('outOfCore'):
+        sys.exit("--sort and --max-memory require --out-of-core. "+usage)
+    if 'storeKind' in options:
+        if options['storeKind'] not in storeQueries:
+            sys.exit("--day-store must be one of: "+', '.join(sorted(storeQueries))+". "+usage)
+        if options.get('outOfCore'):
+            sys.exit("--day-store can't be used with --out-of-core. "+usage)
+        for key in ['startdate','enddate']:
+            if not options.get(key):
+                sys.exit("--day-store requires --start and --end. "+usage)
+            if datecheck(options[key]):
+                sys.exit("Invalid date format: "+datecheck(options[key]))
+    elif 'startdate' in options or 'enddate' in options:
+        sys.exit("--start and --end require --day-store. "+usage)
+
+    if len(args)==0:
+        sys.exit("Not enough arguments. "+usage)
+    elif len(args)==1: #1 argument = queryFile
+        main(args[0],**options)
+    elif len(args)==2: #2 arguments = queryFile, resultDir 
+        main(args[0],args[1],**options)
     else:
-        sys.exit("Too many arguments. Usage:\n\tpython flexibleQuery.py queryFile *resultsDir")
\ No newline at end of file
+        sys.exit("Too many arguments. "+usage)
\ No newline at end of file
@@ -15,13 +15,17 @@ THIS CODE HAS AN UNSTABLE API THAT IS SUBJECT TO CHANGE
 
 """
 import os, re, sys, csv, urllib2, getpass, csv, time, urllib, string, base64
-import StringIO
+import errno
+import StringIO, threading, Queue, copy, atexit, heapq, datetime, weakref
 import simplejson
 import mimetypes
+from htsql_stats import HTSQL_Stats
 VERSION = '0.0.2'
 csv.field_size_limit(1024*1024)   # default is 128K
 __all__ = ['VERSION','htsql_encode','login','latch', 'build_request',
-           'HTSQL_Connection','HTSQL_Error', 'Multiplex']
+           'HTSQL_Connection','HTSQL_Error', 'Multiplex', 'HTSQL_Pending',
+           'HTSQL_AsyncConnection', 'AsyncMultiplex', 'login_async',
+           'gather', 'HTSQL_Batch', 'normalize_uri', 'date_shards']
 _match_name = re.compile("^[A-Za-z0-9_-]+$").match
 
 class HTSQL_Error(Exception):
@@ -103,6 +107,24 @@ def quote_ident(identifier):
     # TODO: finish me, and integrate into functions below
     return identifier
         
+def normalize_uri(uri):
+    """ collapse runs of whitespace outside of quoted literals, so that
+    queries that differ only in layout compare equal """
+    parts = []
+    quoted = False
+    space = False
+    for c in uri.strip():
+        if c == "'":
+            quoted = not quoted
+        elif not quoted and c.isspace():
+            space = True
+            continue
+        if space:
+            parts.append(' ')
+            space = False
+        parts.append(c)
+    return "".join(parts)
+
 def unroll(pairs):
     if type(pairs) == dict:
         pairs = pairs.items()
@@ -199,6 +221,23 @@ class HTSQL_Connection(object):
             a default /~role to be used if one is not provided 
             by the query proper
 
+        ``coalesce``
+            when true (the default), concurrent calls for the same
+            query share a single request; see ``__call__``
+
+        ``record``
+            if set, the path of a file that every query sent by
+            ``__call__`` is appended to (as ``time<TAB>uri``), for
+            replaying with loadTest.py; defaults to the HTSQL_RECORD
+            environment variable
+
+        ``stats``
+            an ``HTSQL_Stats`` catalog that the latency, response size
+            and row count of every query sent by ``__call__`` are
+            recorded in, and that is used to warn before sending
+            queries expected to be slow; opened from the HTSQL_STATS
+            environment variable if it's set, otherwise None
+
     """
     def __init__(self, server, username=None,
                  password=None, perspective=None):
@@ -209,6 +248,16 @@ class HTSQL_Connection(object):
         self.username = username
         self.password = password
         self.perspective = perspective
+        self.coalesce = True
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.coalesce_hits = 0
+        self.coalesce_misses = 0
+        self.record = os.environ.get('HTSQL_RECORD')
+        self.record_lock = threading.Lock()
+        self.stats = None
+        if os.environ.get('HTSQL_STATS'):
+            self.stats = HTSQL_Stats(os.environ['HTSQL_STATS'])
         # be more forgiving if somebody has a trailing /
         if self.server[-1] == '/':
             self.server = self.server[:-1]
@@ -359,6 +408,13 @@ class HTSQL_Connection(object):
                 the column indicated (by name, not position) -- this 
                 only supports the default JSON mimetype
 
+        If another thread is already running the same query (same
+        ``normalize_uri`` text, perspective and index), this call waits
+        for that request instead of sending its own.  Callers commonly
+        rewrite rows in place, so each caller that waited gets its own
+        deep copy of the decoded result; the caller that sent the
+        request gets the original, unless others were waiting for it
+        (then it gets a copy too, since they copy the original).
         """
         index = None
         if args:
@@ -369,8 +425,84 @@ class HTSQL_Connection(object):
                 index = v
                 continue
             assert False, ("unknown kwarg `%s`" % k)
-        response = self.execute(uri)
-        result = self.parse_response(response)
+        if not self.coalesce:
+            return self.perform(uri, index)
+        perspective = None
+        if not uri.startswith("/~"):
+            perspective = self.perspective
+        key = (normalize_uri(uri), perspective, index)
+        with self.inflight_lock:
+            leader = key not in self.inflight
+            if leader:
+                self.inflight[key] = HTSQL_Pending(uri)
+                self.inflight[key].followers = 0
+                self.coalesce_misses += 1
+            else:
+                self.coalesce_hits += 1
+                self.inflight[key].followers += 1
+            pending = self.inflight[key]
+        if not leader:
+            return copy.deepcopy(pending.result())
+        try:
+            pending.set_result(self.perform(uri, index))
+        except Exception:
+            pending.set_error(sys.exc_info())
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+                # nobody can join once the key is gone
+                followers = pending.followers
+        if not followers:
+            return pending.result()
+        # the followers copy the pending result, so it stays untouched
+        return copy.deepcopy(pending.result())
+
+    def coalesce_stats(self):
+        """ number of calls that shared an in-flight request (hits)
+        and that had to send their own (misses) """
+        with self.inflight_lock:
+            return {'hits': self.coalesce_hits,
+                    'misses': self.coalesce_misses}
+
+    def recorded_uri(self, uri):
+        """ a uri as it's recorded and timed, with the perspective the
+        request is sent with """
+        if self.perspective and not uri.startswith("/~"):
+            return "/~%s%s" % (self.perspective, uri)
+        return uri
+
+    def perform(self, uri, index=None, consume=None):
+        """ execute a query and decode the response (see ``__call__``),
+        or pass it to ``consume`` (see ``stream``) """
+        parse = consume or self.parse_response
+        recorded = self.recorded_uri(uri)
+        if self.record:
+            with self.record_lock:
+                with open(self.record, "a") as f:
+                    f.write("%.3f\t%s\n" % (time.time(),
+                                             normalize_uri(recorded)))
+        if self.stats:
+            self.stats.check(recorded)
+            start = time.time()
+            try:
+                response = self.execute(uri)
+                if response:
+                    response = _Counted(response)
+                result = parse(response)
+            except Exception, exce:
+                self.stats.record(recorded, time.time() - start,
+                    error=str(getattr(exce, 'code', None)
+                              or exce.__class__.__name__))
+                raise
+            if consume:
+                nrows = result
+            else:
+                nrows = len(result) if type(result) == list else None
+            self.stats.record(recorded, time.time() - start,
+                              response and response.bytes, nrows)
+        else:
+            response = self.execute(uri)
+            result = parse(response)
         if index is not None:
             mimetype = response.headers.getheader("content-type")
             assert 'json' in mimetype or 'javascript' in mimetype
@@ -382,6 +514,15 @@ class HTSQL_Connection(object):
             return retval
         return result
     
+    def stream(self, uri, consume):
+        """ perform an htsql query (already encoded) without decoding
+        the response: ``consume`` is passed the response (None if the
+        server returned nothing) to read as it arrives, for results too
+        big to load at once, and should return the number of rows it
+        read.  The query is recorded and timed like any other (see
+        ``record`` and ``stats``); returns what ``consume`` returns """
+        return self.perform(uri, consume=consume)
+
     def insert(self, table, locator=None, assignment=None, 
                perspective=None, selector=None):
         """ inserts a row into the given table """
@@ -499,16 +640,91 @@ class HTSQL_Connection(object):
                             perspective=perspective), data, headers)
             
 
+class _Counted(object):
+    """ wraps a response, counting the bytes read from it """
+    def __init__(self, response):
+        self.response = response
+        self.headers = response.headers
+        self.bytes = 0
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.bytes += len(data)
+        return data
+
+    def readlines(self):
+        lines = self.response.readlines()
+        self.bytes += sum(len(line) for line in lines)
+        return lines
+
+def date_shards(startdate, enddate, count, stats=None, uri=None,
+                target=None):
+    """ split the inclusive range of ``YYYY-MM-DD`` dates from
+    ``startdate`` to ``enddate`` into at most ``count`` contiguous
+    ``(start, end)`` sub-ranges, for ``Multiplex.sharded``
+
+    Given the ``HTSQL_Stats`` of the connection and the ``uri`` the
+    shards are for (taking the two dates, as recorded), the range is
+    split into more shards if that's what it takes for each one to run
+    in about ``target`` seconds (see ``HTSQL_Stats.suggest_days``).
+    """
+    first = datetime.datetime.strptime(startdate, "%Y-%m-%d").date()
+    last = datetime.datetime.strptime(enddate, "%Y-%m-%d").date()
+    assert first <= last, "startdate must not be after enddate"
+    days = (last - first).days + 1
+    count = max(1, min(count, days))
+    if stats and uri:
+        probe = uri % (htsql_encode(startdate), htsql_encode(enddate))
+        span = stats.suggest_days(probe, -(-days // count), target)
+        count = max(count, min(days, -(-days // span)))
+    shards = []
+    for n in range(count):
+        start = first + datetime.timedelta(days * n // count)
+        end = first + datetime.timedelta(days * (n + 1) // count - 1)
+        shards.append((start.isoformat(), end.isoformat()))
+    return shards
+
+def merge_sorted(results, key):
+    """ merge shard results into one result sorted by the ``key``
+    column(s); JSON results are lists of dicts, CSV results are lists
+    of rows with a header row first (kept once) """
+    if type(key) in (str, unicode):
+        key = [key]
+    header = None
+    runs = []
+    for (n, result) in enumerate(results):
+        result = result or []
+        if result and type(result[0]) is list:
+            if header is None:
+                header = result[0]
+            assert result[0] == header, "shards returned different columns"
+            columns = [header.index(k) for k in key]
+            result = result[1:]
+        else:
+            columns = key
+        decorated = [(tuple(row[c] for c in columns), n, i, row)
+                     for (i, row) in enumerate(result)]
+        decorated.sort()
+        runs.append(decorated)
+    merged = [row for (k, n, i, row) in heapq.merge(*runs)]
+    if header is not None:
+        merged.insert(0, header)
+    return merged
+
 class Multiplex(object):
     """
     This is a connection that is multiplexed over N servers,
     merging the query results into an indexed result set.
+
+    Servers that are replicas of each other can also share one large
+    query with ``sharded``, each answering part of it.
     """
     def __init__(self, username=None, password=None, perspective=None):
         self.connections = []
         self.username = username
         self.password = password
         self.perspective = perspective
+        self.shard_pool = None
         if not self.username:
             self.username = raw_input("Username? ")
         if not self.password:
@@ -527,9 +743,58 @@ class Multiplex(object):
         assert False, ("handle %s not found" % handle)
     
     def __call__(self, uri, *args, **kwargs):
+        return self.unify([(handle, connection(uri, *args, **kwargs))
+                           for (handle, connection) in self.connections])
+
+    def shard_parts(self, pool, uri, shards):
+        """ queue one request per shard on ``pool``, handing shards to
+        the servers in turn """
+        assert self.connections, "no servers added"
+        parts = []
+        for (n, args) in enumerate(shards):
+            (handle, connection) = self.connections[n % len(self.connections)]
+            parts.append(pool.submit(connection, uri, *args))
+        return parts
+
+    def date_shards(self, uri, startdate, enddate, target=None):
+        """ ``date_shards`` for running ``uri`` (which takes the two
+        dates) with ``sharded``: at least one shard per server, and more
+        if the query statistics say shards that big would take longer
+        than ``target`` seconds """
+        assert self.connections, "no servers added"
+        connection = self.connections[0][1]
+        return date_shards(startdate, enddate, len(self.connections),
+                           connection.stats, connection.recorded_uri(uri),
+                           target)
+
+    def sharded(self, uri, shards, key):
+        """ run one logical query split across replica servers
+
+        ``uri`` takes the arguments of each shard (a tuple in ``shards``,
+        encoded as for ``HTSQL_Connection.__call__``), e.g. the ends of a
+        date sub-range from ``date_shards`` or an ID bucket.  Shards are
+        spread over the servers and run concurrently, and their rows are
+        merge-sorted by the ``key`` column(s) into a single result,
+        without a ``server`` column:
+
+            uri = "/session{date, id()}?date>=%s&date<=%s"
+            fetch.sharded(uri,
+                          fetch.date_shards(uri, '2014-01-01', '2014-12-31'),
+                          key=['date', 'id()'])
+        """
+        if self.shard_pool is None \
+        or self.shard_pool.limit != len(self.connections):
+            # one worker per server, kept for later calls
+            if self.shard_pool:
+                self.shard_pool.close()
+            self.shard_pool = _WorkerPool(len(self.connections))
+        parts = self.shard_parts(self.shard_pool, uri, shards)
+        return merge_sorted(gather(parts), key)
+
+    def unify(self, results):
+        """ merge ``(handle, result)`` pairs, tagging rows by server """
         unified = []
-        for (handle, connection) in self.connections:
-            result = connection(uri, *args, **kwargs)
+        for (handle, result) in results:
             # construct header for CSV output
             if result and type(result[0]) is list:
                 if not unified:
@@ -550,36 +815,559 @@ class Multiplex(object):
                     unified.append(chunk)
         return unified
 
+class HTSQL_Pending(object):
+    """
+    Placeholder for a request queued on a worker pool
+
+    ``result()`` blocks until the request has finished and returns what
+    the equivalent blocking call would have returned; exceptions raised
+    on the worker (``HTSQL_Error`` included) are re-raised in the caller.
+    """
+    def __init__(self, uri=None):
+        self.uri = uri
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, value):
+        self._value = value
+        self._event.set()
+
+    def set_error(self, exc_info):
+        self._error = exc_info
+        self._event.set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("timed out waiting for %s" % self.uri)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+class _Combined(HTSQL_Pending):
+    """ pending result built from several others by ``combine`` """
+    def __init__(self, parts, combine, uri=None):
+        HTSQL_Pending.__init__(self, uri)
+        self.parts = parts
+        self.combine = combine
+
+    def done(self):
+        return all(part.done() for part in self.parts)
+
+    def result(self, timeout=None):
+        if not self._event.is_set():
+            results = gather(self.parts, timeout)
+            try:
+                self.set_result(self.combine(results))
+            except Exception:
+                self.set_error(sys.exc_info())
+        return HTSQL_Pending.result(self, timeout)
+
+def gather(pending, timeout=None):
+    """ wait for each pending request, returning results in order """
+    return [item.result(timeout) for item in pending]
+
+# pools with running workers, cancelled at exit (see ``_cancel_pools``)
+_live_pools = weakref.WeakSet()
+_live_pools_lock = threading.Lock()
+
+def _cancel_pools():
+    """ daemon threads still blocked on a queue at interpreter shutdown
+    print spurious tracebacks, so release them first """
+    with _live_pools_lock:
+        pools = list(_live_pools)
+    for pool in pools:
+        pool.cancel()
+
+atexit.register(_cancel_pools)
+
+class _WorkerPool(object):
+    """ a fixed number of daemon threads draining a request queue """
+    def __init__(self, limit):
+        assert limit > 0, "limit must be positive"
+        self.limit = limit
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submit(self, method, *args, **kwargs):
+        pending = HTSQL_Pending(args and args[0] or None)
+        with self.lock:
+            if not self.workers:
+                with _live_pools_lock:
+                    _live_pools.add(self)
+                for n in range(self.limit):
+                    worker = threading.Thread(target=self.work)
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+        self.queue.put((pending, method, args, kwargs))
+        return pending
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (pending, method, args, kwargs) = item
+            try:
+                pending.set_result(method(*args, **kwargs))
+            except Exception:
+                pending.set_error(sys.exc_info())
+
+    def close(self):
+        """ stop the workers once already queued requests have run """
+        with self.lock:
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+            with _live_pools_lock:
+                _live_pools.discard(self)
+
+    def cancel(self, wait=5):
+        """ stop the workers without running the requests still queued
+        (their ``result()`` raises); requests in progress are given up to
+        ``wait`` seconds to finish """
+        with self.lock:
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is not None:
+                    try:
+                        raise RuntimeError("cancelled: %s" % item[0].uri)
+                    except RuntimeError:
+                        item[0].set_error(sys.exc_info())
+            for worker in self.workers:
+                self.queue.put(None)
+            deadline = time.time() + wait
+            for worker in self.workers:
+                worker.join(max(0, deadline - time.time()))
+            self.workers = []
+            with _live_pools_lock:
+                _live_pools.discard(self)
+
+class HTSQL_AsyncConnection(object):
+    """
+    Non-blocking counterpart of ``HTSQL_Connection``
+
+    Requests are queued and run by at most ``limit`` worker threads
+    sharing one ``HTSQL_Connection``, so hundreds of queries can be in
+    flight while only ``limit`` of them hold a socket.  Every request
+    method mirrors its blocking namesake but returns an ``HTSQL_Pending``;
+    use ``result()`` or ``gather()`` to collect the answers:
+
+        fetch = login_async("http://localhost:8080", "user", "pass")
+        pending = [fetch("/session?date=%s", day) for day in days]
+        sessions = gather(pending)
+
+    Credentials are requested on the calling thread before anything is
+    queued, since prompting from the workers would interleave.
+    """
+    def __init__(self, server, username=None, password=None,
+                 perspective=None, limit=8):
+        self.connection = HTSQL_Connection(server, username,
+                                           password, perspective)
+        self.pool = _WorkerPool(limit)
+        self.server = self.connection.server
+        self.perspective = perspective
+
+    def submit(self, method, *args, **kwargs):
+        """ queue a call to ``method`` (typically bound to
+        ``self.connection``) and return its ``HTSQL_Pending`` """
+        self.connection.query_credentials()
+        return self.pool.submit(method, *args, **kwargs)
+
+    def waitfor(self, maxwait=15):
+        """ blocking, as nothing useful can be queued until it returns """
+        return self.connection.waitfor(maxwait)
+
+    def close(self):
+        self.pool.close()
+
+    def coalesce_stats(self):
+        return self.connection.coalesce_stats()
+
+    def __call__(self, uri, *args, **kwargs):
+        return self.submit(self.connection, uri, *args, **kwargs)
+
+    def map(self, uris, **kwargs):
+        """ queue a list of queries, most expensive first if the
+        connection keeps ``stats``; returns their ``HTSQL_Pending``
+        objects in the order the uris were given """
+        positions = range(len(uris))
+        if self.connection.stats:
+            positions = self.connection.stats.order(positions,
+                                                    key=lambda i: uris[i])
+        pending = [None] * len(uris)
+        for i in positions:
+            pending[i] = self(uris[i], **kwargs)
+        return pending
+
+    def execute(self, uri, data=None, headers={}):
+        return self.submit(self.connection.execute, uri, data, headers)
+
+    def select(self, *args, **kwargs):
+        return self.submit(self.connection.select, *args, **kwargs)
+
+    def insert(self, *args, **kwargs):
+        return self.submit(self.connection.insert, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self.submit(self.connection.update, *args, **kwargs)
+
+    def merge(self, *args, **kwargs):
+        return self.submit(self.connection.merge, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.submit(self.connection.delete, *args, **kwargs)
+
+    def cmd_import(self, *args, **kwargs):
+        return self.submit(self.connection.cmd_import, *args, **kwargs)
+
+class AsyncMultiplex(Multiplex):
+    """
+    ``Multiplex`` whose servers are queried concurrently, with at most
+    ``limit`` requests in flight across all of them.  ``query()`` and
+    ``__call__`` return ``HTSQL_Pending`` objects; the latter resolves
+    to the same server-tagged result as ``Multiplex.__call__``.
+    """
+    def __init__(self, username=None, password=None, perspective=None,
+                 limit=8):
+        Multiplex.__init__(self, username, password, perspective)
+        self.pool = _WorkerPool(limit)
+
+    def query(self, handle, uri, *args, **kwargs):
+        for (code, connection) in self.connections:
+            if handle == code:
+                return self.pool.submit(connection, uri, *args, **kwargs)
+        assert False, ("handle %s not found" % handle)
+
+    def __call__(self, uri, *args, **kwargs):
+        handles = [handle for (handle, connection) in self.connections]
+        parts = [self.pool.submit(connection, uri, *args, **kwargs)
+                 for (handle, connection) in self.connections]
+        return _Combined(parts,
+                         lambda results: self.unify(zip(handles, results)),
+                         uri)
+
+    def sharded(self, uri, shards, key):
+        """ as ``Multiplex.sharded``, returning an ``HTSQL_Pending`` """
+        return _Combined(self.shard_parts(self.pool, uri, shards),
+                         lambda results: merge_sorted(results, key), uri)
+
+    def close(self):
+        self.pool.close()
+
+class HTSQL_Batch(object):
+    """
+    Collects write operations and sends them in as few round trips
+    as their semantics allow
+
+    ``insert`` and ``merge`` operations that only carry a locator and
+    scalar assignments are grouped by table, perspective and column set
+    into ``import()`` payloads of up to ``chunk`` rows.  Everything else
+    (updates, deletes, filtered or selected merges) is pipelined over the
+    worker pool of an ``HTSQL_AsyncConnection``, or over a pool of
+    ``limit`` threads when a plain ``HTSQL_Connection`` is given.  If an
+    import is rejected, its rows are replayed one at a time so that each
+    one gets its own result or error.  If the connection keeps ``stats``,
+    every request is timed, and requests expected to take longest are
+    sent first (see ``HTSQL_Stats.order``).
+
+    Operations in a batch are assumed independent of each other; writes
+    that must happen in order belong in separate batches.  A batch that
+    made its own pool shuts it down on ``close()``, or at the end of a
+    ``with`` block:
+
+        with HTSQL_Batch(fetch) as batch:
+            for (sess, quality) in corrections:
+                batch.update('session', sess, {'quality': quality})
+            results = batch.run()
+            print batch.report()
+    """
+    def __init__(self, connection, limit=8, chunk=500):
+        if isinstance(connection, HTSQL_AsyncConnection):
+            # the connection's pool, left running for the connection
+            self.pool = connection.pool
+            self.own_pool = False
+            connection = connection.connection
+        else:
+            self.pool = _WorkerPool(limit)
+            self.own_pool = True
+        self.connection = connection
+        self.chunk = chunk
+        self.operations = []
+        self.results = []
+        self.elapsed = None
+
+    def insert(self, table, locator=None, assignment=None,
+               perspective=None, selector=None):
+        return self.add('insert', table, locator=locator,
+                        assignment=assignment, perspective=perspective,
+                        selector=selector)
+
+    def update(self, table, locator=None, assignment=None,
+               filter=None, perspective=None, selector=None,
+               expect=None):
+        return self.add('update', table, locator=locator,
+                        assignment=assignment, filter=filter,
+                        perspective=perspective, selector=selector,
+                        expect=expect)
+
+    def merge(self, table, locator=None, assignment=None,
+              filter=None, perspective=None, selector=None):
+        return self.add('merge', table, locator=locator,
+                        assignment=assignment, filter=filter,
+                        perspective=perspective, selector=selector)
+
+    def delete(self, table, locator=None, filter=None,
+               perspective=None, expect=None):
+        return self.add('delete', table, locator=locator, filter=filter,
+                        perspective=perspective, expect=expect)
+
+    def add(self, action, table, **kwargs):
+        """ queue an operation, returning its position in the results """
+        self.operations.append((action, table, kwargs))
+        return len(self.operations) - 1
+
+    def importable(self, operation):
+        """ can this operation be expressed as a row of ``import()``? """
+        (action, table, kwargs) = operation
+        if action not in ('insert', 'merge'):
+            return False
+        if kwargs.get('filter') or kwargs.get('selector'):
+            return False
+        locator = kwargs.get('locator')
+        if type(locator) in (list, tuple):
+            return False
+        assignment = list(unroll(kwargs.get('assignment') or {}))
+        return all(type(v) not in (list, tuple) for (k, v) in assignment)
+
+    def payload(self, columns, rows):
+        """ render import rows as CSV text for ``cmd_import`` """
+        buffer = StringIO.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            cells = []
+            for value in row:
+                if value is None:
+                    value = ''
+                elif value is True or value is False:
+                    value = str(value).lower()
+                elif unicode == type(value):
+                    value = value.encode("utf-8")
+                cells.append(str(value))
+            writer.writerow(cells)
+        return buffer.getvalue().decode("utf-8")
+
+    def run(self):
+        """ send every queued operation and wait for all of them
+
+        Returns one ``(response, error)`` pair per operation, in the
+        order the operations were added; rows sent as one import share
+        that import's response.
+        """
+        start = time.time()
+        self.results = [None] * len(self.operations)
+        groups = {}
+        singles = []
+        for (position, operation) in enumerate(self.operations):
+            if self.importable(operation):
+                (action, table, kwargs) = operation
+                assignment = list(unroll(kwargs.get('assignment') or {}))
+                columns = ['action()']
+                row = [action]
+                if kwargs.get('locator'):
+                    columns.append('id()')
+                    row.append(kwargs['locator'])
+                columns.extend(k for (k, v) in assignment)
+                row.extend(v for (k, v) in assignment)
+                key = (table, kwargs.get('perspective'), tuple(columns))
+                groups.setdefault(key, []).append((position, row))
+            else:
+                singles.append((self.request_uri(operation), position))
+        chunks = []
+        for ((table, perspective, columns), rows) in groups.items():
+            uri = self.connection.recorded_uri(build_request('import()',
+                      table, perspective=perspective))
+            for offset in range(0, len(rows), self.chunk):
+                chunks.append((uri, (table, perspective, columns,
+                                     rows[offset:offset + self.chunk])))
+        requests = [(uri, 'import', job) for (uri, job) in chunks] + \
+                   [(uri, 'single', job) for (uri, job) in singles]
+        if self.connection.stats:
+            requests = self.connection.stats.order(requests,
+                                                   key=lambda r: r[0])
+        imports = []
+        pending = []
+        for (uri, kind, job) in requests:
+            if kind == 'single':
+                pending.append((job, self.send(self.operations[job])))
+                continue
+            (table, perspective, columns, chunk) = job
+            data = self.payload(columns, [row for (p, row) in chunk])
+            imports.append((chunk, self.pool.submit(self.timed, uri,
+                self.connection.cmd_import, table, data,
+                perspective=perspective)))
+        for (chunk, item) in imports:
+            try:
+                response = item.result()
+            except HTSQL_Error:
+                # pin the failure on the offending rows
+                for (position, row) in chunk:
+                    pending.append((position,
+                                    self.send(self.operations[position])))
+                continue
+            for (position, row) in chunk:
+                self.results[position] = (response, None)
+        for (position, item) in pending:
+            try:
+                self.results[position] = (item.result(), None)
+            except HTSQL_Error, exce:
+                self.results[position] = (None, exce)
+        self.elapsed = time.time() - start
+        return self.results
+
+    def send(self, operation):
+        """ pipeline a single operation on the worker pool """
+        (action, table, kwargs) = operation
+        method = getattr(self.connection, action)
+        return self.pool.submit(self.timed, self.request_uri(operation),
+                                method, table, **kwargs)
+
+    def request_uri(self, operation):
+        """ the uri an operation is sent as, for its statistics """
+        (action, table, kwargs) = operation
+        command = action + '()'
+        if action in ('update', 'delete'):
+            command = '%s(expect=%d)' % (action, kwargs.get('expect') or 1)
+        return self.connection.recorded_uri(build_request(command, table,
+                   kwargs.get('locator'), kwargs.get('selector'),
+                   kwargs.get('assignment'), kwargs.get('filter'),
+                   kwargs.get('perspective')))
+
+    def timed(self, uri, method, *args, **kwargs):
+        """ run a write (on a worker), adding it to the connection's
+        ``stats`` as ``uri`` -- the connection only times queries """
+        stats = self.connection.stats
+        if not stats:
+            return method(*args, **kwargs)
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+        except Exception, exce:
+            stats.record(uri, time.time() - start,
+                error=str(getattr(exce, 'code', None)
+                          or exce.__class__.__name__))
+            raise
+        stats.record(uri, time.time() - start)
+        return result
+
+    def errors(self):
+        """ ``(position, HTSQL_Error)`` for each failed operation """
+        return [(position, result[1])
+                for (position, result) in enumerate(self.results)
+                if result and result[1] is not None]
+
+    def rate(self):
+        """ operations per second achieved by the last ``run()`` """
+        if not self.elapsed:
+            return None
+        return len(self.results) / self.elapsed
+
+    def report(self):
+        return "%d operations, %d errors, %.1f seconds, %.1f ops/sec" % (
+                   len(self.results), len(self.errors()),
+                   self.elapsed or 0, self.rate() or 0)
+
+    def close(self):
+        """ stop the batch's own worker pool (requests still queued are
+        cancelled) """
+        if self.own_pool:
+            self.pool.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 def login(server, username=None, password=None, perspective=None):
     connect = HTSQL_Connection(server, username, password, perspective)
     connect.waitfor()
     return connect
 
-def latch(main, pidfile, procname=''):
+def login_async(server, username=None, password=None, perspective=None,
+                limit=8):
+    connect = HTSQL_AsyncConnection(server, username, password,
+                                    perspective, limit)
+    connect.waitfor()
+    return connect
+
+def latch(main, pidfile, procname='', grace=5):
     """ ensure only one copy of a script is running
     
     This helper wraps a ``main`` function implementing an HTSQL script
     with a ``pidfile`` latch so that only one active instance is running
     at any given time.  If stdout notices are helpful, provide a
     ``procname`` with a textual description of the script.
+
+    The pidfile is created exclusively, so two scripts starting at the
+    same time can't both take the latch.  A pidfile without a pid is
+    taken to be just created, and is waited on; if it's still empty
+    ``grace`` seconds after it was written, the script that created it
+    is assumed to have died, and the pidfile is treated as stale.
     """
-    try:
-       data = open(pidfile, "r").read()
-       if data :
-          os.kill(int(data), 0)
-          if procname:
-              print "%s is already running" % procname
-          return
-    except IOError:
-       # pid file is missing, good
-       pass
-    except OSError:
-       if procname:
-           print "stale pid for %s, running..." % procname
-       pass
-    f = open(pidfile, "w")
-    f.write(str(os.getpid()))
-    f.close()
+    while True:
+        try:
+            fd = os.open(pidfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            break
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        try:
+            data = open(pidfile, "r").read()
+        except IOError:
+            # removed since, try again
+            continue
+        try:
+            pid = int(data)
+        except ValueError:
+            # just created and the pid isn't written yet -- unless it's
+            # been left like that by a crash
+            try:
+                age = time.time() - os.path.getmtime(pidfile)
+            except OSError:
+                continue
+            if age < grace:
+                time.sleep(0.1)
+                continue
+            pid = None
+        try:
+            if pid is None:
+                raise OSError(errno.ESRCH, "no pid in %s" % pidfile)
+            os.kill(pid, 0)
+            if procname:
+                print "%s is already running" % procname
+            return
+        except OSError:
+            if procname:
+                print "stale pid for %s, running..." % procname
+        try:
+            if open(pidfile, "r").read() == data:
+                os.unlink(pidfile)
+        except (IOError, OSError):
+            pass
+    os.write(fd, str(os.getpid()))
+    os.close(fd)
     try:
         # run the application
         main()
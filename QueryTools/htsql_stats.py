@@ -0,0 +1,234 @@
+""" htsql_stats
+
+A persistent catalog of how expensive HTSQL queries are, kept in a small
+sqlite database.  Queries are grouped by template -- the URI with its
+literal values (quoted strings and numbers) replaced by ``?`` -- so that
+the same query run for different dates or participants is counted
+together.
+
+For each query sent, the catalog records the time it was sent, the
+latency (seconds, including decoding the response), the size of the
+response in bytes, the number of rows returned, the number of days
+between the first and last dates in the URI (if it has any) and the
+error, if any.
+
+HTSQL_Connection keeps statistics in the file named by the HTSQL_STATS
+environment variable (see ``stats`` in htsql_client), and uses them to
+warn before sending queries that are expected to be slow.  Scripts can
+ask which templates are slowest, how many rows (or days) to request per
+chunk -- ``date_shards`` in htsql_client sizes shards this way -- and
+what order to send concurrent queries in, longest first (as
+``HTSQL_AsyncConnection.map`` and ``HTSQL_Batch`` do).
+
+Usage:
+    python htsql_stats.py [--top=N] statsFile --> print the N slowest
+        query templates (default 10)
+
+"""
+import re, sys, time, math, datetime
+import getopt
+import sqlite3
+import threading
+
+__all__ = ['query_template', 'HTSQL_Stats']
+
+_literal = re.compile(r"'(?:[^']|'')*'")
+_number = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_date = re.compile(r"'(\d{4}-\d{2}-\d{2})'")
+
+def query_template(uri):
+    """ replace the literal values in a uri with ``?`` and collapse
+    whitespace, so that queries differing only in their values share
+    a template """
+    template = _literal.sub("?", uri.strip())
+    template = _number.sub("?", template)
+    return re.sub(r"\s+", " ", template)
+
+def query_days(uri):
+    """ number of days from the first to the last date literal in a
+    uri (inclusive), or None if it has fewer than two """
+    dates = sorted(set(_date.findall(uri)))
+    if len(dates) < 2:
+        return None
+    try:
+        (first, last) = [datetime.datetime.strptime(d, "%Y-%m-%d")
+                         for d in (dates[0], dates[-1])]
+    except ValueError:
+        return None
+    return (last - first).days + 1
+
+class HTSQL_Stats(object):
+    """
+    Query statistics catalog.  Constructor parameters and attributes:
+
+        ``path``
+            sqlite database file; created if it doesn't exist
+
+        ``warn_after``
+            queries whose template has averaged more than this many
+            seconds are warned about before they're sent (see ``check``)
+
+        ``history``
+            only the most recent ``history`` runs of a template are used
+            for estimates, so that they follow changes on the server
+
+    The catalog can be shared by the threads of one connection and by
+    several processes (sqlite does the locking).
+    """
+    def __init__(self, path, warn_after=30.0, history=50):
+        self.path = path
+        self.warn_after = warn_after
+        self.history = history
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute("""create table if not exists query (
+                template text not null, sent real not null,
+                latency real not null, bytes integer,
+                rows integer, error text, days integer)""")
+            columns = [c[1] for c in
+                       self.db.execute("pragma table_info(query)")]
+            if 'days' not in columns:
+                # catalog from before days were recorded
+                self.db.execute("alter table query add column days integer")
+            self.db.execute("""create index if not exists query_template
+                on query (template, sent)""")
+            self.db.commit()
+
+    def record(self, uri, latency, nbytes=None, nrows=None, error=None):
+        """ add one run of a query to the catalog """
+        with self.lock:
+            self.db.execute("""insert into query (template, sent, latency,
+                bytes, rows, error, days) values (?,?,?,?,?,?,?)""",
+                            (query_template(uri), time.time(), latency,
+                             nbytes, nrows, error, query_days(uri)))
+            self.db.commit()
+
+    def runs(self, template):
+        """ (latency, bytes, rows, days) for the recent successful runs
+        of a template, most recent first """
+        with self.lock:
+            return self.db.execute("""select latency, bytes, rows, days
+                from query where template=? and error is null
+                order by sent desc limit ?""",
+                (template, self.history)).fetchall()
+
+    def summary(self, uri):
+        """ dict of statistics for the template of a uri, or None if it
+        hasn't been run: runs, errors, mean latency, p95 latency, mean
+        bytes, mean rows and rows per day (for runs with dates) """
+        template = query_template(uri)
+        runs = self.runs(template)
+        if not runs:
+            return None
+        with self.lock:
+            (errors,) = self.db.execute("""select count(*) from query
+                where template=? and error is not null""",
+                (template,)).fetchone()
+        latencies = sorted(r[0] for r in runs)
+        dated = [r for r in runs if r[2] is not None and r[3]]
+        rows_per_day = None
+        if dated:
+            rows_per_day = float(sum(r[2] for r in dated)) / \
+                           sum(r[3] for r in dated)
+        return {'template': template,
+                'runs': len(runs),
+                'errors': errors,
+                'latency': sum(latencies) / len(latencies),
+                'p95': latencies[int(math.ceil(.95 * len(latencies))) - 1],
+                'bytes': _mean(r[1] for r in runs),
+                'rows': _mean(r[2] for r in runs),
+                'rows_per_day': rows_per_day}
+
+    def estimate(self, uri):
+        """ expected latency of a uri in seconds, or None if unknown """
+        summary = self.summary(uri)
+        if summary is None:
+            return None
+        return summary['latency']
+
+    def check(self, uri):
+        """ warn if a uri is expected to take longer than ``warn_after``;
+        returns the estimate """
+        expected = self.estimate(uri)
+        if expected is not None and expected > self.warn_after:
+            print "Expensive query (about %.1f s): %s" % (
+                      expected, query_template(uri)[:200])
+        return expected
+
+    def suggest_chunk(self, uri, rows, target=None):
+        """ given a uri that returns about ``rows`` rows per chunk, how
+        many rows a chunk should have to take about ``target`` seconds
+        (default ``warn_after``); returns ``rows`` if unknown """
+        summary = self.summary(uri)
+        if target is None:
+            target = self.warn_after
+        if not summary or not summary['rows'] or not summary['latency']:
+            return rows
+        per_second = summary['rows'] / summary['latency']
+        return max(1, int(per_second * target))
+
+    def suggest_days(self, uri, days, target=None):
+        """ given a uri that covers about ``days`` days per chunk, how
+        many days a chunk should cover to take about ``target`` seconds:
+        the rows ``suggest_chunk`` suggests, at the rows per day of recent
+        runs; returns ``days`` if unknown """
+        summary = self.summary(uri)
+        if not summary or not summary['rows_per_day']:
+            return days
+        rows = self.suggest_chunk(uri, days * summary['rows_per_day'], target)
+        return max(1, int(rows / summary['rows_per_day']))
+
+    def order(self, items, key=None):
+        """ items (uris, or anything ``key`` maps to a uri) sorted so
+        that the most expensive are sent first, which keeps the total run
+        time of concurrent queries down; queries that haven't been run
+        yet go first, since they might be slow """
+        def cost(item):
+            expected = self.estimate(key(item) if key else item)
+            if expected is None:
+                return float('inf')
+            return expected
+        return sorted(items, key=cost, reverse=True)
+
+    def slowest(self, top=10):
+        """ summaries of the ``top`` templates with the highest mean
+        latency """
+        with self.lock:
+            templates = [t for (t,) in self.db.execute(
+                "select distinct template from query")]
+        summaries = [s for s in (self.summary(t) for t in templates) if s]
+        summaries.sort(key=lambda s: s['latency'], reverse=True)
+        return summaries[:top]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return float(sum(values)) / len(values)
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython htsql_stats.py [--top=N] statsFile"
+    try:
+        (opts, args) = getopt.getopt(sys.argv[1:], '', ['top='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err) + "\n" + usage)
+    if len(args) != 1:
+        sys.exit(usage)
+    top = 10
+    for (opt, value) in opts:
+        if opt == '--top':
+            top = int(value)
+    stats = HTSQL_Stats(args[0])
+    print "%6s %6s %9s %9s %11s %9s  %s" % ('Runs', 'Errors', 'Mean (s)',
+              'p95 (s)', 'Bytes', 'Rows', 'Template')
+    for s in stats.slowest(top):
+        print "%6i %6i %9.2f %9.2f %11.0f %9.0f  %s" % (s['runs'],
+                  s['errors'], s['latency'], s['p95'], s['bytes'] or 0,
+                  s['rows'] or 0, s['template'])
+    stats.close()
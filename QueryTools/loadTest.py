@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+""" loadTest.py
+
+    Replays recorded audit queries against an HTSQL server at a set concurrency and
+    request rate, to see how the server and client behave when several people run
+    audits at the same time.
+
+    Recording: set the HTSQL_RECORD environment variable to a file name before running
+    any of the query scripts, and every query they send is appended to that file
+    (see HTSQL_Connection in htsql_client.py), e.g.
+        HTSQL_RECORD=/tmp/audit_uris.txt python weeklyCheckQuery.py 2014-08-01 2014-08-07
+
+    Replaying:
+        python loadTest.py [options] recordFile server
+
+    Options:
+        --concurrency=8     number of requests in flight at once
+        --rate=0            requests started per second (0 = as fast as possible)
+        --repeat=1          number of times to replay the recorded queries
+
+    Only read queries are replayed (anything that calls insert(), update(), etc. is
+    skipped). Identical queries are not coalesced, so every replayed request reaches
+    the server. Latency is measured from when each request was due to start (by
+    --rate, or when it was submitted), so requests that wait for a free connection
+    count the wait. At the end, the script prints the latency percentiles
+    (p50/p95/p99), throughput and error rate for each type of query (the table
+    queried, e.g. /session or /run), and overall.
+
+"""
+
+import sys, re, time, math
+import getopt
+import getpass
+from sys import stdin, stdout
+from htsql_client import login_async
+
+WRITES = re.compile(r"/(insert|update|merge|delete|import)\(")
+
+def readRecording(recordFile):
+    """ Read the URIs from a recording, skipping any writes """
+    uris = []
+    for line in open(recordFile):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        uri = line.split('\t',1)[-1]
+        if not WRITES.search(uri):
+            uris.append(uri)
+    return uris
+
+def queryType(uri):
+    """ The table a query starts from (e.g. /session), ignoring any /~perspective """
+    match = re.match(r"(/~[^/]+)?(/[^/{?\[(:]*)",uri)
+    if not match:
+        return uri
+    return match.group(2)
+
+def percentile(values,p):
+    """ Nearest-rank percentile of a list of numbers """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    rank = max(1,int(math.ceil(p/100.0*len(values))))
+    return values[rank-1]
+
+def timedQuery(connection,uri,scheduled):
+    """ Run a query, returning (latency in seconds, error or None). Latency is
+    measured from when the request was scheduled to start, not from when a worker
+    picked it up, so time spent queued behind slow requests counts. """
+    try:
+        connection(uri)
+        error = None
+    except Exception, err:
+        error = err.__class__.__name__
+    return time.time()-scheduled,error
+
+def replay(client,uris,rate=0,repeat=1):
+    """ Replay uris through an HTSQL_AsyncConnection (its limit sets the concurrency).
+    Returns the wall time and a list of (query type, latency, error) for every
+    request. """
+    connection = client.connection
+    connection.coalesce = False
+
+    start = time.time()
+    pending = []
+    for (n,uri) in enumerate(uris*repeat):
+        if rate:
+            # pace the requests -- wait until this one is due. If the replay falls
+            # behind, the request still counts as starting when it was due.
+            scheduled = start+n/float(rate)
+            delay = scheduled-time.time()
+            if delay>0:
+                time.sleep(delay)
+        else:
+            scheduled = time.time()
+        pending.append((queryType(uri),client.submit(timedQuery,connection,uri,scheduled)))
+    results = [(kind,)+item.result() for (kind,item) in pending]
+    elapsed = time.time()-start
+    return elapsed,results
+
+def report(elapsed,results,out=stdout):
+    """ Print latency percentiles, throughput and error rate per query type """
+    kinds = sorted(set(kind for (kind,latency,error) in results))
+    out.write("%-24s %8s %9s %9s %9s %9s %8s\n" % ('Query type','Requests','p50 (s)','p95 (s)','p99 (s)','Req/s','Errors'))
+    for kind in kinds+[None]:
+        subset = [r for r in results if kind is None or r[0]==kind]
+        latencies = [latency for (k,latency,error) in subset]
+        errors = [error for (k,latency,error) in subset if error]
+        out.write("%-24s %8i %9.3f %9.3f %9.3f %9.2f %7.1f%%\n" % (
+            kind or 'ALL',len(subset),percentile(latencies,50),percentile(latencies,95),
+            percentile(latencies,99),len(subset)/elapsed if elapsed else 0,
+            100.0*len(errors)/len(subset) if subset else 0))
+    allErrors = [error for (k,latency,error) in results if error]
+    for error in sorted(set(allErrors)):
+        out.write("    %s: %i\n" % (error,allErrors.count(error)))
+    return
+
+def main(recordFile,server,concurrency=8,rate=0,repeat=1):
+    """ Log in to the target server, replay a recording and print the report """
+    uris = readRecording(recordFile)
+    if not uris:
+        sys.exit("No queries to replay in "+recordFile)
+
+    print "**Log in to %s**" % server
+    stdout.write("Username: ")
+    u = stdin.readline().strip()
+    p = getpass.getpass("Password: ").strip()
+    client = login_async(server,u,p,limit=concurrency)
+
+    print "Replaying %i queries x %i, concurrency %i, rate %s/s" % (len(uris),repeat,concurrency,rate or 'max')
+    (elapsed,results) = replay(client,uris,rate,repeat)
+    client.close()
+    print "Done in %.1f s" % elapsed
+    report(elapsed,results)
+    return
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython loadTest.py [--concurrency=8] [--rate=0] [--repeat=1] recordFile server"
+    try:
+        (opts,args) = getopt.getopt(sys.argv[1:],'',['concurrency=','rate=','repeat='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err)+"\n"+usage)
+    if len(args)!=2:
+        sys.exit(usage)
+    options = {}
+    for (opt,value) in opts:
+        if opt=='--concurrency':
+            options['concurrency'] = int(value)
+        elif opt=='--rate':
+            options['rate'] = float(value)
+        elif opt=='--repeat':
+            options['repeat'] = int(value)
+    main(args[0],args[1],**options)
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+""" matExport.py
+
+    Writes a MATLAB .mat file (level 5 format) next to a results csv, holding the
+    variables fields and data exactly as ReadInQuery.m would return them, so that
+    MATLAB can load the results instead of parsing the csv line by line:
+
+        fields      1xN cell of column names, with "array" and whitespace removed
+        data        cell with one row per result row and one column per field:
+                    - columns with "array" in the name: a 1xK cell of items (numbers
+                      as doubles), or {} if there are none
+                    - columns with "date" in the name, and the derived date columns
+                      (WeekStart etc., see derivedColumns.py): [Y M D], or [-1 -1 -1]
+                      if the date is missing or can't be read (YYYY-MM-DD or M/D/YY)
+                    - other columns: a double if the entry is a number, [] if it's
+                      empty, otherwise a string
+    As in ReadInQuery.m, whitespace is squeezed out of every entry.
+
+    For a results file Results_X.csv, the .mat file is Results_X.mat (the same name
+    that AuditQuery.m saves its processed results under). ReadInQuery.m loads it
+    instead of the csv if it's at least as new as the csv.
+
+    The data cell is written column by column through temporary files, so big
+    results don't have to be held in memory.
+
+    If the results have a schema (see querySchema.py), the columns are instead decoded
+    and validated in bulk with it, a block of rows at a time (BLOCK_ROWS in
+    querySchema.py), and each cell is written from its declared type:
+    dates, numbers and arrays aren't guessed from the column name, and a value that
+    doesn't match its type raises a SchemaError instead of being written as [-1 -1 -1]
+    or a string. Text columns are still written as ReadInQuery.m would (a double if the
+    text is a number), since the MATLAB scripts compare IDs as numbers.
+
+    Usage:
+        python matExport.py [schemaName] resultsFile
+
+"""
+
+import os, sys, re
+import csv, time, struct
+import tempfile, shutil
+from derivedColumns import dateColumns, formatDates
+from querySchema import SCHEMAS, Column, Categorical, readResultBlocks, DATE, INT
+
+# data types
+miINT8 = 1
+miINT32 = 5
+miUINT32 = 6
+miDOUBLE = 9
+miMATRIX = 14
+miUINT16 = 4
+# array classes
+mxCELL_CLASS = 1
+mxCHAR_CLASS = 4
+mxDOUBLE_CLASS = 6
+
+def matName(resultFile):
+    """ Name of the .mat file for a results file """
+    return os.path.splitext(resultFile)[0]+'.mat'
+
+def fileHeader():
+    text = 'MATLAB 5.0 MAT-file, Platform: %s, Created on: %s' % (sys.platform,time.ctime())
+    return text.ljust(116)[:116]+'\0'*8+struct.pack('<H',0x0100)+'IM'
+
+def element(dataType,data):
+    """ Data element: tag, data and padding to a multiple of 8 bytes """
+    return struct.pack('<II',dataType,len(data))+data+'\0'*(-len(data)%8)
+
+def matrixHeader(arrayClass,dims,bodySize,name=''):
+    """ Start of a miMATRIX element whose data subelements take bodySize bytes """
+    subelements = element(miUINT32,struct.pack('<II',arrayClass,0)) + \
+                  element(miINT32,struct.pack('<%ii' % len(dims),*dims)) + \
+                  element(miINT8,name)
+    return struct.pack('<II',miMATRIX,len(subelements)+bodySize)+subelements
+
+def matrix(arrayClass,dims,body,name=''):
+    return matrixHeader(arrayClass,dims,len(body),name)+body
+
+def double(values,name=''):
+    """ 1xN double array ([] if values is empty) """
+    dims = (1,len(values)) if values else (0,0)
+    return matrix(mxDOUBLE_CLASS,dims,element(miDOUBLE,struct.pack('<%id' % len(values),*values)),name)
+
+def char(text,name=''):
+    """ 1xN char array ('' if text is empty) """
+    if type(text)!=unicode:
+        text = text.decode('utf-8','replace')
+    data = text.encode('utf-16-le')
+    dims = (1,len(data)/2) if data else (0,0)
+    return matrix(mxCHAR_CLASS,dims,element(miUINT16,data),name)
+
+def cell(items,dims=None,name=''):
+    """ Cell array of already encoded elements (1xN by default, {} if empty) """
+    if dims is None:
+        dims = (1,len(items)) if items else (0,0)
+    return matrix(mxCELL_CLASS,dims,''.join(items),name)
+
+def toNumber(entry):
+    """ entry as a float, or None if it isn't a number (like str2double, NaN
+    doesn't count) """
+    try:
+        value = float(entry)
+    except ValueError:
+        return None
+    if value!=value:
+        return None
+    return value
+
+def fieldName(header):
+    """ Column name as ReadInQuery.m returns it """
+    return ''.join(header.replace('array','').split())
+
+def cellEntry(header,entry,dates=()):
+    """ Encoded data cell for one entry of a results csv (see ReadInQuery.m).
+    Columns named in dates are read as dates too. """
+    entry = ''.join(entry.split()) #squeeze out white space
+    if 'array' in header.lower():
+        if entry.startswith('['):
+            entry = entry[1:]
+        if entry.endswith(']'):
+            entry = entry[:-1]
+        if not entry:
+            return cell([])
+        items = []
+        for item in re.split('(?:###)+',entry):
+            value = toNumber(item)
+            items.append(char(item) if value is None else double([value]))
+        return cell(items)
+    elif 'date' in header.lower() or header in dates:
+        if not entry:
+            return double([-1,-1,-1])
+        parts = entry.split('/')
+        if len(parts)==3:
+            parts = [parts[2],parts[0],parts[1]]
+        else:
+            parts = entry.split('-')
+        if len(parts[0])==2:
+            parts[0] = '20'+parts[0]
+        values = [toNumber(p) for p in parts]
+        if None in values:
+            return double([-1,-1,-1])
+        return double(values)
+    else:
+        if not entry:
+            return double([])
+        value = toNumber(entry)
+        if value is None:
+            return char(entry)
+        return double([value])
+
+def textEntry(text):
+    """ Encoded data cell for text from a typed column (a double if it's a number,
+    [] if it's empty, otherwise a string, as in ReadInQuery.m) """
+    text = ''.join(text.split())
+    if not text:
+        return double([])
+    value = toNumber(text)
+    if value is None:
+        return char(text)
+    return double([value])
+
+def typedEntries(values):
+    """ Encoded data cells for a column decoded by querySchema.py """
+    if isinstance(values,Categorical):
+        values = values.values()
+    if values.dtype.kind=='M':
+        return [double([float(p) for p in d.split('-')]) if d else double([-1,-1,-1])
+                for d in formatDates(values)]
+    elif values.dtype.kind in 'if':
+        return [double([]) if v!=v else double([float(v)]) for v in values]
+    entries = []
+    for value in values:
+        if isinstance(value,tuple):
+            entries.append(cell([textEntry(item) for item in value]))
+        elif value is None:
+            entries.append(double([]))
+        else:
+            entries.append(textEntry(value))
+    return entries
+
+def schemaBlocks(resultFile,schema):
+    """ Decode a results file with a schema (a list of Columns, or the name of one of
+    the SCHEMAS in querySchema.py) a block of rows at a time, yielding the encoded
+    data cells for each column (in the order of the headers) for each block. Derived
+    columns (see derivedColumns.py) are typed too. """
+    with open(resultFile,'rb') as f:
+        headers = csv.reader(f).next()
+    if isinstance(schema,basestring):
+        schema = SCHEMAS[schema]
+    schema = list(schema)+[Column(name,DATE) for name in dateColumns() if name in headers]
+    if 'BinnedAge' in headers:
+        schema.append(Column('BinnedAge',INT))
+    for block in readResultBlocks(resultFile,schema):
+        decoded = dict(block)
+        yield [typedEntries(decoded[h]) for h in headers]
+
+def writeMat(resultFile,matFile=None,schema=None):
+    """ Write fields and data for resultFile (see above), decoding the columns with
+    schema if it's given. Returns the number of rows. """
+    if matFile is None:
+        matFile = matName(resultFile)
+    with open(resultFile,'rb') as f:
+        f_csv = csv.reader(f)
+        try:
+            headers = f_csv.next()
+        except StopIteration:
+            headers = []
+        columns = [tempfile.TemporaryFile() for header in headers]
+        dates = dateColumns()
+        try:
+            nrows = 0
+            if schema and headers:
+                for block in schemaBlocks(resultFile,schema):
+                    for (column,entries) in zip(columns,block):
+                        column.writelines(entries)
+                    nrows += len(block[0])
+            else:
+                for row in f_csv:
+                    for (c,header) in enumerate(headers):
+                        columns[c].write(cellEntry(header,row[c] if c<len(row) else '',dates))
+                    nrows += 1
+
+            with open(matFile,'wb') as out:
+                out.write(fileHeader())
+                out.write(cell([char(fieldName(h)) for h in headers],name='fields'))
+                dims = (nrows,len(headers)) if nrows else (0,0)
+                bodySize = sum(column.tell() for column in columns) if nrows else 0
+                out.write(matrixHeader(mxCELL_CLASS,dims,bodySize,'data'))
+                if nrows:
+                    # MATLAB stores cells column by column
+                    for column in columns:
+                        column.seek(0)
+                        shutil.copyfileobj(column,out)
+        finally:
+            for column in columns:
+                column.close()
+    return nrows
+
+if '__main__' == __name__:
+    if len(sys.argv) not in (2,3) or (len(sys.argv)==3 and sys.argv[1] not in SCHEMAS):
+        sys.exit("Usage:\n\tpython matExport.py [schemaName] resultsFile\n\tschemas: "+', '.join(sorted(SCHEMAS)))
+    schema = sys.argv[1] if len(sys.argv)==3 else None
+    print "%i rows saved: %s" % (writeMat(sys.argv[-1],schema=schema),matName(sys.argv[-1]))
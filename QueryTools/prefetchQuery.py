@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+""" prefetchQuery.py
+
+    Runs the weekly check queries ahead of time (e.g. overnight, from cron), so that
+    weeklyCheck.m doesn't have to wait for MRIC.
+
+    The script predicts the date ranges of the next weekly check from the end date
+    (yesterday, the last full day, by default):
+        week        the WEEK_DAYS days up to the end date
+        window      the graph window that weeklyCheck.m passes to ETLAuditGraphs.m:
+                    from WINDOW_WEEKS weeks before the Monday on or before the end
+                    date, up to the end date (about three months)
+    and fills the day stores in weeklyCheckQuery.py for them:
+        session     window (read by weeklyCheckQuery.py, and by ETLAuditGraphs.m
+                    through flexibleQuery.py --day-store=session)
+        phase       week (read by weeklyCheckQuery.py)
+        run         window (read by ETLAuditGraphs.m through flexibleQuery.py
+                    --day-store=run)
+
+    Each day is saved with the time it was fetched (see dayStore.py). Days that have
+    settled are only fetched once. More recent days are fetched again by every
+    prefetch (unless they were fetched in the last REFETCH_AGE seconds), and are then
+    reused by the weekly check for MAX_AGE (in dayStore.py) after the prefetch. So
+    when weeklyCheckQuery.py and ETLAuditGraphs.m run the next day, they only check
+    the fetch times and query the days since the prefetch (e.g. today).
+
+    The prefetch runs under a pidfile latch (see latch in htsql_client.py), so a
+    scheduled run that overlaps the previous one does nothing.
+
+    To log in without being prompted (e.g. from cron), set MRIC_USERNAME and
+    MRIC_PASSWORD in the environment. For example, to prefetch at 2am every day:
+
+        0 2 * * * MRIC_USERNAME=... MRIC_PASSWORD=... python /path/to/QueryTools/prefetchQuery.py
+
+    Usage:
+        python prefetchQuery.py [--end=YYYY-MM-DD] --> prefetch the week and window
+            ending on the end date (default: yesterday)
+
+"""
+
+import os, sys
+import datetime, getopt
+import weeklyCheckQuery
+from weeklyCheckQuery import _login, datecheck, openStore, \
+    fillSessionStore, fillPhaseStore, fillRunStore
+from htsql_client import latch
+
+###
+WEEK_DAYS = 7 #days in a weekly check
+WINDOW_WEEKS = 11 #weeks before the last week in the graph window (as in weeklyCheck.m)
+REFETCH_AGE = 60*60 #seconds after which recent days are fetched again by the prefetch
+LOCK_FILE = weeklyCheckQuery.STORE_PATH+'prefetch.pid'
+###
+
+def predictRanges(enddate=None):
+    """ (week, window) date ranges, each a (startdate, enddate) tuple, for a weekly
+    check ending on enddate (default: yesterday) """
+    if enddate:
+        end = datetime.datetime.strptime(enddate,'%Y-%m-%d').date()
+    else:
+        end = datetime.date.today()-datetime.timedelta(days=1)
+    week = (end-datetime.timedelta(days=WEEK_DAYS-1),end)
+    lastWeekStart = end-datetime.timedelta(days=end.weekday()) #monday on or before end
+    window = (lastWeekStart-datetime.timedelta(weeks=WINDOW_WEEKS),end)
+    return (tuple(d.isoformat() for d in week),tuple(d.isoformat() for d in window))
+
+def prefetch(fetch,enddate=None):
+    """ Query MRIC for the days in the predicted ranges that aren't cached, or that
+    haven't settled and weren't fetched in the last REFETCH_AGE seconds """
+    (week,window) = predictRanges(enddate)
+    print "Week: %s to %s, window: %s to %s" % (week+window)
+
+    for (kind,fill,(startdate,enddate)) in [('session',fillSessionStore,window),
+                                            ('phase',fillPhaseStore,week),
+                                            ('run',fillRunStore,window)]:
+        fetched = fill(fetch,openStore(kind),startdate,enddate,REFETCH_AGE)
+        for (first,last) in fetched:
+            print "Stored %s results for %s to %s" % (kind,first,last)
+        if not fetched:
+            print "%s results are up to date" % kind.capitalize()
+    return
+
+def main(enddate=None):
+    try:
+        fetch = _login(os.environ.get('MRIC_USERNAME'),os.environ.get('MRIC_PASSWORD'))
+    except Exception, err:
+        print "Sorry, wrong username or password. \n more::", err
+        sys.exit(-1)
+    if not os.path.exists(weeklyCheckQuery.STORE_PATH):
+        os.makedirs(weeklyCheckQuery.STORE_PATH)
+    latch(lambda: prefetch(fetch,enddate),LOCK_FILE,'prefetchQuery.py')
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython prefetchQuery.py [--end=YYYY-MM-DD]"
+    try:
+        (opts,args) = getopt.getopt(sys.argv[1:],'',['end='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err)+"\n"+usage)
+    if args:
+        sys.exit(usage)
+    enddate = dict(opts).get('--end')
+    if enddate and datecheck(enddate):
+        sys.exit("Invalid date format: " + datecheck(enddate))
+    main(enddate)
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+""" protocolBitmap.py
+
+    Writes a protocol dictionary and a packed per-row bitmap next to a results csv
+    that has a protocol array column (e.g. 'Protocol array' in the session query),
+    so that MATLAB can filter rows by protocol with bit operations instead of
+    string matching (see ReadProtocolBits.m).
+
+    For a results file Results_X.csv, two files are written:
+        Results_X_protocols.csv     Protocol,Word,Bit -- one row per unique protocol,
+                                    sorted (same order as ProtocolLogic.m)
+        Results_X_protocolBits.csv  Word1,Word2,... -- one row per row of results.
+                                    Bit B of word W is set if that row includes the
+                                    protocol listed with Word W and Bit B.
+    Words and bits are numbered from 1 (for MATLAB's bitget). Each word holds 32
+    protocols, so the values stay exact as doubles.
+
+    Usage:
+        python protocolBitmap.py resultsFile
+
+"""
+
+import sys
+import csv
+
+WORDBITS = 32
+
+def protocolTokens(entry):
+    """ Split a formatted array entry ([a###b]) into a list of items, the same way
+    that ReadInQuery.m does (empty entries are skipped). """
+    entry = ''.join(entry.split())
+    if entry.startswith('['):
+        entry = entry[1:]
+    if entry.endswith(']'):
+        entry = entry[:-1]
+    return [item for item in entry.split('###') if item]
+
+def findProtocolCol(headers):
+    """ Index of the protocol array column, or None if there isn't one """
+    for i,header in enumerate(headers):
+        if 'protocol' in header.lower() and 'array' in header.lower():
+            return i
+    return None
+
+def packWords(tokens,position,nWords):
+    """ Packed words for one row's protocols, given each protocol's position in the
+    dictionary """
+    words = [0]*nWords
+    for p in tokens:
+        (w,b) = divmod(position[p],WORDBITS)
+        words[w] |= 1<<b
+    return words
+
+def sidecarNames(resultFile):
+    base = resultFile[:-4] if resultFile.lower().endswith('.csv') else resultFile
+    return base+'_protocols.csv',base+'_protocolBits.csv'
+
+def readProtocolColumn(resultFile,protocolCol=None):
+    """ Yield the protocols of each row of a results csv, one row at a time """
+    with open(resultFile) as f:
+        f_csv = csv.reader(f)
+        f_csv.next() #headers
+        for row in f_csv:
+            yield protocolTokens(row[protocolCol])
+
+def writeProtocolBitmap(resultFile,protocolCol=None):
+    """ Write the protocol dictionary and bitmap for a results csv. Returns the names
+    of the files written, or None if the results have no protocol array column (or
+    no headers). The results are read twice (once for the dictionary, then once
+    for the bitmap), a row at a time, so big results don't have to fit in memory. """
+    with open(resultFile) as f:
+        try:
+            headers = csv.reader(f).next()
+        except StopIteration:
+            return None
+    if protocolCol is None:
+        protocolCol = findProtocolCol(headers)
+    if protocolCol is None:
+        return None
+
+    allProtocols = set()
+    for tokens in readProtocolColumn(resultFile,protocolCol):
+        allProtocols.update(tokens)
+    allProtocols = sorted(allProtocols)
+    position = dict((p,i) for (i,p) in enumerate(allProtocols))
+    nWords = max(1,(len(allProtocols)+WORDBITS-1)//WORDBITS)
+    (dictFile,bitsFile) = sidecarNames(resultFile)
+
+    with open(dictFile,'w') as f:
+        f_csv = csv.writer(f)
+        f_csv.writerow(['Protocol','Word','Bit'])
+        for (i,p) in enumerate(allProtocols):
+            f_csv.writerow([p,i//WORDBITS+1,i%WORDBITS+1])
+
+    with open(bitsFile,'w') as f:
+        f_csv = csv.writer(f)
+        f_csv.writerow(['Word%i' % (w+1) for w in range(nWords)])
+        for tokens in readProtocolColumn(resultFile,protocolCol):
+            f_csv.writerow(packWords(tokens,position,nWords))
+
+    return dictFile,bitsFile
+
+if '__main__' == __name__:
+    if len(sys.argv)!=2:
+        sys.exit("Usage:\n\tpython protocolBitmap.py resultsFile")
+    if not writeProtocolBitmap(sys.argv[1]):
+        sys.exit("No protocol array column in "+sys.argv[1])
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+""" protocolGroups.py
+
+    Splits a results csv into one file per protocol group (e.g. AllInfants, or a
+    single protocol), so that the graphing scripts only have to load their own slice
+    of the results.
+
+    Protocol groups are read from a config file (protocolGroups.csv, next to this
+    script, by default) with the columns dir, title and protocols, where protocols
+    are separated by ###. ETLAuditGraphs.m reads the same file (ReadProtocolGroups.m).
+    A row belongs to a group if any of its protocols contains any of the group's
+    protocols (the same matching as SessionAuditGraphs.m and RunAuditGraphs.m).
+
+    The results are streamed through once, and each row is written straight to the
+    files of the groups it belongs to, so the (possibly very big, see the
+    --out-of-core option of flexibleQuery.py) results are never held in memory. Each
+    distinct protocol is matched against the groups once, so assigning a row is a
+    lookup per protocol rather than string matching. Each group's protocol bitmap
+    (see protocolBitmap.py), row-offset index (see resultReader.py) and .mat file
+    (see matExport.py) are then written in parallel by a pool of worker processes,
+    which are only sent the names of the group files. ETLAuditGraphs.m calls this
+    (through PartitionResults.m) after each query, and graphs each group from its
+    own file.
+
+    Usage:
+        python protocolGroups.py resultsFile outDir --> writes
+            outDir/[group dir]/[name of resultsFile] for each group
+
+    Options (before resultsFile):
+        --config=file       protocol group config (default: protocolGroups.csv)
+        --workers=N         number of worker processes (default: number of CPUs)
+
+"""
+
+import os, sys
+import csv
+import getopt
+import multiprocessing
+from protocolBitmap import protocolTokens, findProtocolCol, writeProtocolBitmap
+from resultReader import writeIndex
+from matExport import writeMat
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'protocolGroups.csv')
+
+def readGroups(configFile=CONFIG_FILE):
+    """ Read protocol groups, returning a list of dicts (dir, title, protocol) """
+    groups = []
+    with open(configFile) as f:
+        for row in csv.DictReader(f):
+            groups.append({'dir':row['dir'].strip(),
+                           'title':row['title'].strip(),
+                           'protocol':[p.strip() for p in row['protocols'].split('###') if p.strip()]})
+    return groups
+
+def groupMatcher(groups):
+    """ Function from a row's protocols to the indices of the groups it belongs to.
+    Each distinct protocol is matched against the groups once. """
+    cache = {}
+    def match(tokens):
+        members = set()
+        for p in tokens:
+            if p not in cache:
+                cache[p] = frozenset(i for (i,group) in enumerate(groups)
+                                     if any(g in p for g in group['protocol']))
+            members |= cache[p]
+        return members
+    return match
+
+def finishGroup(filename):
+    """ Write the protocol bitmap, row-offset index and .mat file for one group's
+    results (run in a worker process) """
+    writeProtocolBitmap(filename)
+    writeIndex(filename)
+    writeMat(filename)
+    return filename
+
+def partition(resultFile,outDir,groups=None,workers=None):
+    """ Write the rows of resultFile that belong to each group to
+    outDir/[group dir]/[name of resultFile]. Returns (filename, number of rows)
+    for each group. """
+    if groups is None:
+        groups = readGroups()
+    name = os.path.basename(resultFile)
+    filenames = [os.path.join(outDir,group['dir'],name) for group in groups]
+    for dirname in set(os.path.dirname(filename) for filename in filenames):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    counts = [0]*len(groups)
+    with open(resultFile) as f:
+        f_csv = csv.reader(f)
+        headers = f_csv.next()
+        protocolCol = findProtocolCol(headers)
+        if protocolCol is None:
+            raise RuntimeError("No protocol array column in "+resultFile)
+        match = groupMatcher(groups)
+        outFiles = [open(filename,'w') for filename in filenames]
+        try:
+            writers = [csv.writer(out) for out in outFiles]
+            for writer in writers:
+                writer.writerow(headers)
+            for row in f_csv:
+                for i in match(protocolTokens(row[protocolCol])):
+                    writers[i].writerow(row)
+                    counts[i] += 1
+        finally:
+            for out in outFiles:
+                out.close()
+
+    # only file names go to the workers -- each one reads its own group's file
+    pool = multiprocessing.Pool(workers)
+    try:
+        pool.map(finishGroup,filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return zip(filenames,counts)
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython protocolGroups.py [--config=file] [--workers=N] resultsFile outDir"
+    try:
+        (opts,args) = getopt.getopt(sys.argv[1:],'',['config=','workers='])
+    except getopt.GetoptError, err:
+        sys.exit(str(err)+"\n"+usage)
+    if len(args)!=2:
+        sys.exit(usage)
+    configFile = CONFIG_FILE
+    workers = None
+    for (opt,value) in opts:
+        if opt=='--config':
+            configFile = value
+        elif opt=='--workers':
+            workers = int(value)
+
+    for (filename,n) in partition(args[0],args[1],readGroups(configFile),workers):
+        print "%6i rows: %s" % (n,filename)
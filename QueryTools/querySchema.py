@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+""" querySchema.py
+
+    Declarative column schemas for MRIC query results, and bulk decoding of results
+    into typed NumPy arrays.
+
+    ReadInQuery.m guesses the type of each cell from the column name at read time
+    (and flags anything it can't read as a date with [-1 -1 -1]). Here each query
+    declares the type of each of its columns instead, and whole columns are decoded
+    and validated at once. Values that don't match the declared type raise a
+    SchemaError listing the offending rows, rather than being silently replaced.
+    weeklyCheckQuery.py writes its .mat files from the decoded columns (see
+    matExport.py), so MATLAB loads data that has already been typed and checked.
+
+    Column kinds and what they decode to:
+        DATE            datetime64[D] array (NaT if missing). Accepts MRIC's format
+                        (YYYY-MM-DD) or Excel's default (M(M)/D(D)/YY(YY)).
+        INT             int64 array. Nullable INT columns decode to float64, with NaN
+                        for missing values.
+        FLOAT           float64 array (NaN if missing)
+        CATEGORICAL     Categorical (int codes, -1 if missing, plus a sorted list of
+                        categories)
+        STRING          object array of strings (None if missing)
+        STRING_ARRAY    object array of tuples of strings. Accepts lists (as returned
+                        by MRIC) or formatted entries ([a###b], as written to csv).
+
+    Usage:
+        python querySchema.py schemaName resultsFile --> decodes a results csv with
+            one of the schemas in SCHEMAS (e.g. session, phase or run) and prints a
+            summary of each column.
+
+"""
+
+import sys
+import csv
+import itertools
+import numpy as np
+from protocolBitmap import protocolTokens
+
+###
+BLOCK_ROWS = 50000 #rows decoded at a time when reading results files in blocks
+###
+
+DATE = 'date'
+INT = 'int'
+FLOAT = 'float'
+CATEGORICAL = 'categorical'
+STRING = 'string'
+STRING_ARRAY = 'string array'
+
+class SchemaError(Exception):
+    """ Values in a column do not match the declared type """
+    def __init__(self, column, kind, bad):
+        self.column = column
+        self.kind = kind
+        self.bad = bad
+
+    def __str__(self):
+        shown = ', '.join('row %i: %r' % (i+1,v) for (i,v) in self.bad[:10])
+        if len(self.bad)>10:
+            shown += ', ... (%i total)' % len(self.bad)
+        return "Column '%s' (%s): %s" % (self.column,self.kind,shown)
+
+class Column(object):
+    """ Name and type of a column. Missing values are an error if nullable is False. """
+    def __init__(self, name, kind, nullable=True):
+        self.name = name
+        self.kind = kind
+        self.nullable = nullable
+
+    def __repr__(self):
+        return "Column(%r, %r, nullable=%r)" % (self.name,self.kind,self.nullable)
+
+class Categorical(object):
+    """ Decoded categorical column: codes index into categories (-1 = missing) """
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def values(self):
+        """ Object array of the original values (None if missing) """
+        lookup = np.array(list(self.categories)+[None],dtype=object)
+        return lookup[self.codes]
+
+# Column titles must match the queries in weeklyCheckQuery.py
+SCHEMAS = {
+    'session': [Column('Date',DATE,nullable=False),
+                Column('Protocol array',STRING_ARRAY),
+                Column('Iscan Type',CATEGORICAL),
+                Column('ID',STRING,nullable=False),
+                Column('Matlab ID',STRING),
+                Column('Session number',INT),
+                Column('Age (months)',FLOAT),
+                Column('Quality',INT),
+                Column('Fellows',STRING),
+                Column('Number of clips',INT,nullable=False)],
+    'phase': [Column('Matlab ID',STRING),
+              Column('ID',STRING,nullable=False),
+              Column('Study Code',CATEGORICAL),
+              Column('Protocol',CATEGORICAL),
+              Column('Enrollment Date',DATE),
+              Column('Phase',STRING),
+              Column('Requirement',CATEGORICAL),
+              Column('Status',CATEGORICAL),
+              Column('Ideal Date',DATE),
+              Column('Fulfillment Date',DATE)],
+    'run': [Column('Date',DATE,nullable=False),
+            Column('Session ID',STRING,nullable=False),
+            Column('Protocol array',STRING_ARRAY),
+            Column('Age (months)',FLOAT),
+            Column('Quality',INT),
+            Column('Clip',STRING),
+            Column('Status',CATEGORICAL),
+            Column('Sample count',INT),
+            Column('Fix count',INT),
+            Column('Lost count',INT)],
+}
+
+def isMissing(value):
+    return value is None or (isinstance(value,basestring) and not value.strip())
+
+def isoDate(value):
+    """ Normalize a date to YYYY-MM-DD, or return None if it can't be read """
+    value = value.strip()
+    parts = value.split('/')
+    if len(parts)==3:
+        (m,d,y) = parts
+        if len(y)==2:
+            y = '20'+y
+        value = '-'.join((y,m.zfill(2),d.zfill(2)))
+    try:
+        np.datetime64(value,'D')
+    except ValueError:
+        return None
+    if len(value)!=10:
+        return None
+    return value
+
+def decodeColumn(values, column):
+    """ Decode and validate a list of values (one per row) for a column """
+    missing = [isMissing(v) for v in values]
+    if not column.nullable and any(missing):
+        raise SchemaError(column.name,column.kind,
+                          [(i,v) for (i,v) in enumerate(values) if missing[i]])
+
+    if column.kind==DATE:
+        try:
+            return np.array([('NaT' if m else v) for (v,m) in zip(values,missing)],
+                            dtype='datetime64[D]')
+        except ValueError:
+            pass
+        # not all in MRIC's format -- normalize (and find anything unreadable)
+        iso = [(None if m else isoDate(v)) for (v,m) in zip(values,missing)]
+        bad = [(i,v) for (i,v) in enumerate(values) if not missing[i] and iso[i] is None]
+        if bad:
+            raise SchemaError(column.name,column.kind,bad)
+        return np.array([(d or 'NaT') for d in iso],dtype='datetime64[D]')
+
+    elif column.kind in (INT,FLOAT):
+        try:
+            decoded = np.array([(np.nan if m else v) for (v,m) in zip(values,missing)],
+                               dtype=np.float64)
+        except ValueError:
+            bad = []
+            for (i,v) in enumerate(values):
+                try:
+                    missing[i] or float(v)
+                except ValueError:
+                    bad.append((i,v))
+            raise SchemaError(column.name,column.kind,bad)
+        if column.kind==INT:
+            ok = np.isnan(decoded) | (decoded==np.round(decoded))
+            if not ok.all():
+                raise SchemaError(column.name,column.kind,
+                                  [(i,values[i]) for i in np.flatnonzero(~ok)])
+            if not column.nullable:
+                return decoded.astype(np.int64)
+        return decoded
+
+    elif column.kind==CATEGORICAL:
+        categories = sorted(set(v for (v,m) in zip(values,missing) if not m))
+        position = dict((c,i) for (i,c) in enumerate(categories))
+        codes = np.array([(-1 if m else position[v]) for (v,m) in zip(values,missing)],
+                         dtype=np.int64)
+        return Categorical(codes,categories)
+
+    elif column.kind==STRING:
+        decoded = np.empty(len(values),dtype=object)
+        decoded[:] = [(None if m else (v if isinstance(v,basestring) else str(v)))
+                      for (v,m) in zip(values,missing)]
+        return decoded
+
+    elif column.kind==STRING_ARRAY:
+        decoded = np.empty(len(values),dtype=object)
+        for (i,v) in enumerate(values):
+            if missing[i]:
+                decoded[i] = ()
+            elif isinstance(v,list):
+                decoded[i] = tuple(str(t) for t in v)
+            else:
+                decoded[i] = tuple(protocolTokens(str(v)))
+        return decoded
+
+    raise ValueError("Unknown column kind: %s" % column.kind)
+
+def decode(headers, rows, schema):
+    """ Decode rows (lists of values in the order of headers) with a schema (a list
+    of Columns, or the name of one of SCHEMAS). Returns a list of (name, array)
+    pairs: the schema's columns first, then any extra columns as strings. """
+    if isinstance(schema,basestring):
+        schema = SCHEMAS[schema]
+    known = [c.name for c in schema]
+    absent = [name for name in known if name not in headers]
+    if absent:
+        raise SchemaError(', '.join(absent),'missing column',[])
+
+    columns = list(schema)+[Column(h,STRING) for h in headers if h not in known]
+    return [(c.name,decodeColumn([row[headers.index(c.name)] for row in rows],c))
+            for c in columns]
+
+def decodeQuery(queryResult, schema):
+    """ Decode a query result (list of dicts, as returned by MRIC). An empty result
+    decodes to empty columns. """
+    if isinstance(schema,basestring):
+        schema = SCHEMAS[schema]
+    if not queryResult:
+        headers = [c.name for c in schema]
+    else:
+        headers = [k for k in queryResult[0].keys() if k.count('htsql:')==0]
+    return decode(headers,[[row[h] for h in headers] for row in queryResult],schema)
+
+def readResults(filename, schema):
+    """ Read a results csv (written by flexibleQuery.py or weeklyCheckQuery.py) and
+    decode it """
+    with open(filename) as f:
+        f_csv = csv.reader(f)
+        headers = f_csv.next()
+        rows = list(f_csv)
+    return decode(headers,rows,schema)
+
+def readResultBlocks(filename, schema, blockRows=BLOCK_ROWS):
+    """ Read and decode a results csv blockRows rows at a time, so that big results
+    don't have to be held in memory. Yields the decoded columns of each block (as
+    from decode). Rows in a SchemaError are numbered from the start of the file.
+    Categorical columns are coded separately in each block. """
+    with open(filename) as f:
+        f_csv = csv.reader(f)
+        headers = f_csv.next()
+        start = 0
+        while True:
+            rows = list(itertools.islice(f_csv,blockRows))
+            if not rows and start:
+                return
+            try:
+                yield decode(headers,rows,schema)
+            except SchemaError, err:
+                raise SchemaError(err.column,err.kind,[(start+i,v) for (i,v) in err.bad])
+            if len(rows)<blockRows:
+                return
+            start += len(rows)
+
+if '__main__' == __name__:
+    if len(sys.argv)!=3:
+        sys.exit("Usage:\n\tpython querySchema.py schemaName resultsFile\n\tschemas: "+', '.join(sorted(SCHEMAS)))
+    try:
+        for (name,values) in readResults(sys.argv[2],sys.argv[1]):
+            if isinstance(values,Categorical):
+                print "%-20s %i rows, %i categories" % (name,len(values),len(values.categories))
+            else:
+                print "%-20s %i rows, %s" % (name,len(values),values.dtype)
+    except SchemaError, err:
+        sys.exit("Invalid results: %s" % err)
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+
+""" resultReader.py
+
+    Random access to results csvs (e.g. a multi-month run export), without reading
+    the file from the start.
+
+    writeIndex writes a row-offset index next to a results file: for Results_X.csv,
+    Results_X.idx starts with a header holding the size and modification time of the
+    csv when it was indexed, followed by the byte offset where each row of results
+    starts, plus the size of the file at the end, as little-endian unsigned 64-bit
+    integers. Quoted fields are taken into account, so a newline inside quotes
+    doesn't start a row.
+
+    ResultReader memory-maps a results file and uses its index to get at rows
+    directly -- only the rows that are asked for are parsed. If the index is missing,
+    or the size or modification time in its header don't match the file (e.g. the
+    file was rewritten), it's rebuilt.
+
+        reader = ResultReader('Results_X.csv')
+        len(reader)                     number of rows
+        reader[10]                      row 10, as a list of strings
+        reader[100:200]                 a list of rows
+        reader.row(10)                  row 10, as a dict of column name -> value
+        reader.column('Session ID')     one column, for every row
+        reader.columns(['Date','Clip'],slice(100,200))
+                                        a list of columns, for rows 100 to 199
+
+    Usage:
+        python resultReader.py resultsFile --> write (or rewrite) the index
+        python resultReader.py resultsFile N [M] --> print rows N to M (or row N)
+
+"""
+
+import os, sys
+import csv, mmap, struct
+from cStringIO import StringIO
+
+OFFSETSIZE = struct.calcsize('<Q')
+HEADER = struct.Struct('<4sQd') #magic, size and mtime of the indexed csv
+MAGIC = 'RIDX'
+CHUNK = 4096 #offsets packed at a time
+
+def indexName(resultFile):
+    """ Name of the index file for a results file """
+    return os.path.splitext(resultFile)[0]+'.idx'
+
+def scanOffsets(f):
+    """ Byte offsets where each row after the header starts in the csv file f, plus
+    the offset of the end of the file. A line ends a row only if it leaves an even
+    number of quotes open (csv writes a quote in a field as two quotes). """
+    offsets = []
+    pos = 0
+    quotes = 0
+    header = True
+    for line in f:
+        pos += len(line)
+        quotes += line.count('"')
+        if quotes%2==0:
+            if header:
+                header = False
+            else:
+                offsets.append(rowStart)
+            rowStart = pos
+            quotes = 0
+    if quotes:
+        raise RuntimeError("Unterminated quoted field in results file")
+    offsets.append(pos)
+    return offsets
+
+def fileStamp(f):
+    """ (size, mtime) of an open file """
+    stat = os.fstat(f.fileno())
+    return stat.st_size,stat.st_mtime
+
+def writeIndex(resultFile):
+    """ Write the row-offset index for resultFile. Returns the number of rows. """
+    with open(resultFile,'rb') as f:
+        #stamp the file before scanning it, so a change during the scan shows up
+        (size,mtime) = fileStamp(f)
+        offsets = scanOffsets(f)
+    with open(indexName(resultFile),'wb') as f:
+        f.write(HEADER.pack(MAGIC,size,mtime))
+        for i in xrange(0,len(offsets),CHUNK):
+            chunk = offsets[i:i+CHUNK]
+            f.write(struct.pack('<%iQ' % len(chunk),*chunk))
+    return len(offsets)-1
+
+def readIndex(resultFile):
+    """ Read the packed row offsets from the index for resultFile, or None if it's
+    missing or out of date """
+    filename = indexName(resultFile)
+    if not os.path.exists(filename):
+        return None
+    with open(filename,'rb') as f:
+        index = f.read()
+    if len(index)<HEADER.size:
+        return None
+    (magic,size,mtime) = HEADER.unpack_from(index)
+    with open(resultFile,'rb') as f:
+        stamp = fileStamp(f)
+    index = index[HEADER.size:]
+    if magic!=MAGIC or (size,mtime)!=stamp or not index or len(index)%OFFSETSIZE or \
+            struct.unpack_from('<Q',index,len(index)-OFFSETSIZE)[0]!=size:
+        return None
+    return index
+
+def parseRow(text):
+    return csv.reader(StringIO(text)).next()
+
+class ResultReader(object):
+    """ Random access to the rows of a results csv, through a memory map and the
+    row-offset index (see writeIndex) """
+    def __init__(self,resultFile):
+        self.filename = resultFile
+        self.index = readIndex(resultFile)
+        if self.index is None:
+            writeIndex(resultFile)
+            self.index = readIndex(resultFile)
+        self.nrows = len(self.index)/OFFSETSIZE-1
+        self.file = open(resultFile,'rb')
+        if self.offset(self.nrows):
+            self.mm = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            self.mm = '' #can't map an empty file
+        self.headers = parseRow(self.mm[:self.offset(0)]) if self.offset(0) else []
+
+    def __len__(self):
+        return self.nrows
+
+    def offset(self,i):
+        """ Byte offset where row i starts (or of the end of the file, for i=len) """
+        return struct.unpack_from('<Q',self.index,i*OFFSETSIZE)[0]
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self.rowAt(i) for i in xrange(*index.indices(len(self)))]
+        if index<0:
+            index += len(self)
+        if not 0<=index<len(self):
+            raise IndexError("Row index out of range")
+        return self.rowAt(index)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.rowAt(i)
+
+    def rowAt(self,i):
+        return parseRow(self.mm[self.offset(i):self.offset(i+1)])
+
+    def row(self,index):
+        """ Row as a dict of column name -> value """
+        return dict(zip(self.headers,self[index]))
+
+    def column(self,name,rows=slice(None)):
+        """ List of values in column name, for the rows in the slice rows """
+        return self.columns([name],rows)[0]
+
+    def columns(self,names,rows=slice(None)):
+        """ List of columns (lists of values), one per name, for the rows in the
+        slice rows """
+        cols = []
+        for name in names:
+            if name not in self.headers:
+                raise RuntimeError("No column named "+name+" in "+self.filename)
+            cols.append(self.headers.index(name))
+        rowList = self[rows]
+        return [[row[c] if c<len(row) else '' for row in rowList] for c in cols]
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+if '__main__' == __name__:
+    usage = "Usage:\n\tpython resultReader.py resultsFile *firstRow *lastRow"
+    if len(sys.argv)<2 or len(sys.argv)>4:
+        sys.exit(usage)
+    if len(sys.argv)==2:
+        print "%i rows indexed: %s" % (writeIndex(sys.argv[1]),indexName(sys.argv[1]))
+    else:
+        first = int(sys.argv[2])
+        last = int(sys.argv[-1])
+        with ResultReader(sys.argv[1]) as reader:
+            f_csv = csv.writer(sys.stdout)
+            f_csv.writerow(reader.headers)
+            for row in reader[first:last+1]:
+                f_csv.writerow(row)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+""" streamingExport.py
+
+    Helpers for exporting query results that are too big to hold in memory (e.g.
+    the unfiltered session table pulled by ETLAuditGraphs.m). Used by
+    flexibleQuery.py with --out-of-core.
+
+    iterJSONArray reads the rows of a JSON array one at a time from the server
+    response, instead of loading the whole response. If the rows need to be
+    sorted, ExternalSorter keeps rows in memory up to a configurable limit, spills
+    each full batch to a temporary file as a sorted run, and then streams all of the
+    runs back in order with a single merge.
+
+"""
+
+import os
+import codecs, heapq, tempfile, shutil
+import cPickle as pickle
+import simplejson
+
+CHUNKSIZE = 64*1024 #bytes read from the response at a time
+
+def parseMemory(text):
+    """ Convert a memory limit like '512M', '2G' or '100000' to a number of bytes """
+    text = text.strip().upper()
+    units = {'K':1024,'M':1024**2,'G':1024**3}
+    if text and text[-1] in units:
+        return int(float(text[:-1])*units[text[-1]])
+    return int(text)
+
+def iterJSONArray(f,chunkSize=CHUNKSIZE):
+    """ Yield (item, size) for each item of the JSON array in the file-like object f,
+    where size is the length of the item's JSON text. Only one chunk of the
+    response (plus the item currently being read) is held in memory. """
+    decoder = simplejson.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators
+        while pos<len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+        if not started and pos<len(buf):
+            if buf[pos]!=u'[':
+                raise ValueError("Response is not a JSON array")
+            started = True
+            pos += 1
+            continue
+        if started and pos<len(buf) and buf[pos]==u']':
+            return
+
+        if pos<len(buf):
+            try:
+                (item,end) = decoder.raw_decode(buf,pos)
+            except ValueError:
+                end = None
+            # only trust the item if it's followed by more text (a number cut off at
+            # the end of the chunk would still parse)
+            if end is not None and (end<len(buf) or eof):
+                yield item,end-pos
+                pos = end
+                continue
+            if eof:
+                raise ValueError("Response ended in the middle of an item")
+
+        if eof:
+            if not started:
+                return
+            raise ValueError("Response ended before the end of the array")
+        chunk = f.read(chunkSize)
+        if not chunk:
+            eof = True
+            buf = buf[pos:]+utf8.decode('',final=True)
+        else:
+            buf = buf[pos:]+utf8.decode(chunk)
+        pos = 0
+
+class ExternalSorter(object):
+    """ Sorts (key, row) pairs that may not fit in memory.
+
+        maxMemory   approximate number of bytes of rows to hold before spilling a
+                    sorted run to a temporary file
+        tempDir     where runs are written (default: system temp directory)
+
+    Call add() for each row, then iterate over merged() for rows in key order
+    (ties keep the order that they were added in). Call cleanup() when done.
+    """
+    def __init__(self,maxMemory,tempDir=None):
+        self.maxMemory = maxMemory
+        self.dir = tempfile.mkdtemp(prefix='flexibleQuery_',dir=tempDir)
+        self.runs = []
+        self.buffer = []
+        self.size = 0
+        self.count = 0
+
+    def add(self,key,row,size):
+        self.buffer.append((key,self.count,row))
+        self.count += 1
+        self.size += size
+        if self.size>=self.maxMemory:
+            self.spill()
+
+    def spill(self):
+        """ Write the buffered rows out as a sorted run """
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        runFile = os.path.join(self.dir,'run%i' % len(self.runs))
+        with open(runFile,'wb') as f:
+            pickler = pickle.Pickler(f,pickle.HIGHEST_PROTOCOL)
+            for item in self.buffer:
+                pickler.dump(item)
+                pickler.clear_memo()
+        self.runs.append(runFile)
+        self.buffer = []
+        self.size = 0
+
+    def readRun(self,runFile):
+        with open(runFile,'rb') as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    return
+
+    def merged(self):
+        """ Yield rows in key order """
+        if not self.runs:
+            # everything fit in memory
+            self.buffer.sort()
+            for (key,n,row) in self.buffer:
+                yield row
+            return
+        self.spill()
+        for (key,n,row) in heapq.merge(*[self.readRun(r) for r in self.runs]):
+            yield row
+
+    def cleanup(self):
+        shutil.rmtree(self.dir,ignore_errors=True)
@@ -24,7 +24,20 @@
     The script creates a CSV file for each of the queries, all saved in a subdirectory of
     QUERY_PATH. The subdirectory is named by start and end date (e.g. 2014-08-01_2014-08-14).
     The CSV files are also named by the range of dates for the query plus a keyword 
-    (e.g. session_2014-08-01_2014-08-14).
+    (e.g. session_2014-08-01_2014-08-14). The session results also get a protocol
+    dictionary and bitmap (see protocolBitmap.py), and each CSV file gets a row-offset
+    index for random access (see resultReader.py) and a .mat file with the results
+    already parsed for MATLAB, with each column decoded and checked against its schema
+    (see matExport.py and querySchema.py). The session (and run) results also
+    get BinnedAge, WeekStart and date bin columns (see derivedColumns.py).
+
+    If USE_DAY_STORE is set, results are also cached by day in STORE_PATH (see dayStore.py),
+    and only the days in the range that haven't been fetched yet (or that were fetched too
+    long ago to still be current) are queried. The CSV files are then put together from the
+    cached days. Phase editor rows are cached under the day that the participant was paid
+    (see fillPhaseStore). prefetchQuery.py fills the cache ahead of time (e.g. overnight),
+    so that the weekly check itself only has to query the days since then. The session and
+    run stores are shared with the audit graphs (see flexibleQuery.py --day-store).
 
     After running the query and saving the results, the script will ask the user if they
     want to run another query. If the user says yes, the script will prompt them again for 
@@ -35,7 +48,8 @@
     aka it will not give the user the option to run queries on additional date ranges.
 
     * There is a function defined for a run table query, but not currently running it (b/c
-    it isn't being used for our weekly checks).
+    it isn't being used for our weekly checks). ETLAuditGraphs.m runs it through
+    flexibleQuery.py --day-store=run instead.
 
     ***************
     
@@ -48,11 +62,19 @@ import csv, time, datetime
 import getpass
 from sys import stdin, stdout
 from htsql_client import login
+from dayStore import DayStore, MAX_AGE
+from protocolBitmap import writeProtocolBitmap
+from resultReader import writeIndex
+from matExport import writeMat, matName
+from querySchema import SchemaError
+from derivedColumns import DerivedColumns
 
 ###
 ORIG_PATH=os.getcwd()
 QUERY_PATH = '/Users/etl/Desktop/DataQueries/WeeklyChecks/' #where results are saved
 RESULTSFILE = '.csv' # suffix for the filename
+STORE_PATH = QUERY_PATH+'days/' #day-partitioned cache of session/phase/run results (see dayStore.py)
+USE_DAY_STORE = True
 ###
 
 def _login(u=None, p=None, perspective='full_access'):
@@ -101,10 +123,9 @@ def print_headers(csv_writer,keyOrder):
     csv_writer.writerow(keyOrder)
     return
 
-def print_query(csv_writer,queryResult,keyOrder):
-    """ Write out the query result """
-    keymap=dict(zip(keyOrder,range(1,len(keyOrder)+1)))
-
+def format_query(queryResult,keyOrder):
+    """ Format the query result for MATLAB, returning a list of rows (each a list of
+    values in keyOrder) """
     # fix array output so that MATLAB can handle it easily
     for arrayCol in (k for k in keyOrder if k.count('array')>0): 
         for row in queryResult:
@@ -120,43 +141,72 @@ def print_query(csv_writer,queryResult,keyOrder):
             if row['Fellows']:
                 row['Fellows']=row['Fellows'].replace(',','&')
 
-    for row in queryResult:
-        ordered_values = [row[key] for key in keyOrder]
+    return [[row[key] for key in keyOrder] for row in queryResult]
+
+def print_query(csv_writer,queryResult,keyOrder):
+    """ Write out the query result """
+    for ordered_values in format_query(queryResult,keyOrder):
         csv_writer.writerow(ordered_values)
         #TODO - catch UnicodeEncodeError
     return
 
-def sessionTableQuery(fetch,filename,startdate,enddate):
-    """" Run the session table query and write out results. """
+#orderOfKeys must exactly match the queryResult keys! if query is changed, this line must also change to match it.
+#This is the order that will be used to print the results to a file 
+orderOfKeys_session=['Date','Protocol array','Iscan Type','ID','Matlab ID',
+'Session number','Age (months)','Quality','Fellows','Number of clips']
+
+orderOfKeys_run=['Date','Session ID','Protocol array','Age (months)','Quality','Clip','Status','Sample count','Fix count','Lost count']
 
-    queryResult_session=fetch("/session{date title 'Date'+, array(individual.participation.protocol) title 'Protocol array',\
+orderOfKeys_phase=['Matlab ID', 'ID', 'Study Code', 'Protocol', 'Enrollment Date', 'Phase', 'Requirement', 'Status', 'Ideal Date', 'Fulfillment Date']
+
+def openStore(kind):
+    """ DayStore for the "session", "phase" or "run" results, in STORE_PATH """
+    keyOrders = {'session':orderOfKeys_session,'phase':orderOfKeys_phase,'run':orderOfKeys_run}
+    return DayStore(STORE_PATH+kind,keyOrders[kind])
+
+def fetchSessions(fetch,startdate,enddate):
+    """ Run the session table query, return the query result """
+    return fetch("/session{date title 'Date'+, array(individual.participation.protocol) title 'Protocol array',\
         iscan_type title 'Iscan Type', individual.id() title 'ID', individual.matlab_id title 'Matlab ID', \
         code title 'Session number', age_testing_months title 'Age (months)', quality title 'Quality', \
         experimenter title 'Fellows', count(run.clip) title 'Number of clips'} \
         ?date>=%s&date<=%s",startdate,enddate)
-    
-    #orderOfKeys must exactly match the queryResult keys! if query is changed, this line must also change to match it.
-    #This is the order that will be used to print the results to a file 
-    orderOfKeys_session=['Date','Protocol array','Iscan Type','ID','Matlab ID',
-    'Session number','Age (months)','Quality','Fellows','Number of clips']
-    
+
+def fillSessionStore(fetch,store,startdate,enddate,maxAge=MAX_AGE):
+    """ Query the days in the range that the session DayStore is missing (see
+    DayStore.missing) and save them. Returns the (first, last) ranges that were queried. """
+    missing = store.missing(startdate,enddate,maxAge)
+    for (first,last) in missing:
+        fetchedAt = time.time()
+        rowsByDay = {}
+        for row in format_query(fetchSessions(fetch,first,last),orderOfKeys_session):
+            rowsByDay.setdefault(row[0],[]).append(row)
+        store.update(first,last,rowsByDay,fetchedAt)
+    return missing
+
+def sessionTableQuery(fetch,filename,startdate,enddate,store=None):
+    """" Run the session table query and write out results. If a DayStore is passed
+    in, only query the days that it's missing. """
+
+    if store:
+        fillSessionStore(fetch,store,startdate,enddate)
+        store.assemble(filename,startdate,enddate,derived=True)
+        return
+
+    queryResult_session=fetchSessions(fetch,startdate,enddate)
     with open(filename,'w') as f:
-        f_csv = csv.writer(f)
+        f_csv = DerivedColumns(csv.writer(f))
         print_headers(f_csv,orderOfKeys_session)
         print_query(f_csv,queryResult_session,orderOfKeys_session)
+        f_csv.flush()
 
     return
 
-def runTableQuery(fetch,filename,startdate,enddate):
-    """ Run the run table query and write out results. 
-    Running this query in chunks, because the database will only output 
+def fetchRuns(fetch,startdate,enddate):
+    """ Run the run table query, yielding the query result for each chunk.
+    Running this query in chunks (by month), because the database will only output 
     a limited number of rows at a time. """
 
-    orderOfKeys_run=['Date','Session ID','Protocol array','Age (months)','Quality','Clip','Status','Sample count','Fix count','Lost count']
-    
-    f = open(filename,'w')
-    f_csv=csv.writer(f)
-    
     (startyear, startmonth, startday) = datestr_conv(startdate)
     (endyear, endmonth, endday) = datestr_conv(enddate)
 
@@ -206,18 +256,42 @@ def runTableQuery(fetch,filename,startdate,enddate):
                 run_data.fixation title 'Fix count',run_data.lost title 'Lost count'} \
                 ?session.date%s'%s'&session.date<='%s'" % (startDateChar,startdate_run,enddate_run)
             
-            queryResult_run=fetch(runQuery)
-            if firstLoop:
-                print_headers(f_csv,orderOfKeys_run)
-                firstLoop=0
-            print_query(f_csv,queryResult_run,orderOfKeys_run)
+            yield fetch(runQuery)
+            firstLoop=0
+
+def fillRunStore(fetch,store,startdate,enddate,maxAge=MAX_AGE):
+    """ Query the days in the range that the run DayStore is missing (see
+    DayStore.missing) and save them. Returns the (first, last) ranges that were queried. """
+    missing = store.missing(startdate,enddate,maxAge)
+    for (first,last) in missing:
+        fetchedAt = time.time()
+        rowsByDay = {}
+        for queryResult_run in fetchRuns(fetch,first,last):
+            for row in format_query(queryResult_run,orderOfKeys_run):
+                rowsByDay.setdefault(row[0],[]).append(row)
+        store.update(first,last,rowsByDay,fetchedAt)
+    return missing
+
+def runTableQuery(fetch,filename,startdate,enddate,store=None):
+    """ Run the run table query and write out results. If a DayStore is passed in,
+    only query the days that it's missing. """
+
+    if store:
+        fillRunStore(fetch,store,startdate,enddate)
+        store.assemble(filename,startdate,enddate,derived=True)
+        return
 
-    f.close()
+    with open(filename,'w') as f:
+        f_csv=DerivedColumns(csv.writer(f))
+        print_headers(f_csv,orderOfKeys_run)
+        for queryResult_run in fetchRuns(fetch,startdate,enddate):
+            print_query(f_csv,queryResult_run,orderOfKeys_run)
+        f_csv.flush()
 
     return
 
-def phaseEditQuery(fetch,filename,startdate,enddate):
-    """ Run the phase editor query and write out results.
+def fetchPhases(fetch,startdate,enddate):
+    """ Run the phase editor queries, return the prelim and final query results.
     First run a prelim query, finding all participants who were paid in the 
     date range in question. Then run the real query, which looks for compensation 
     AND eye tracking sessions for those ID/phase/protocol combinations returned 
@@ -230,7 +304,8 @@ def phaseEditQuery(fetch,filename,startdate,enddate):
     ((requirement_type.title~'Compensation')&fulfillment_date>='"+startdate+"'&fulfillment_date<='"+enddate+"')|\
     ((requirement_type.title~'tracking')&fulfillment_date>='"+startdate+"'&fulfillment_date<='"+enddate+"')"
     phase_prelim = fetch(phaseQuery_prelim)
-
+    if not phase_prelim:
+        return phase_prelim,[]
 
     #note: removing "Day..." from phases, so that it returns all eyetracking sessions (not just the day when they were compensated)
     PhaseFilters = ["(phase.participation.individual = '{ID}' & requirement_type.phase_type.title ~ '{Phase}'\
@@ -247,9 +322,44 @@ def phaseEditQuery(fetch,filename,startdate,enddate):
         phase.ideal_date title 'Ideal Date'}?\
         (",PhaseFilters,")&((requirement_type.title=~'tracking'&status!='skipped')|(requirement_type.title=~'compensation'))")) 
     
-    queryResult_phase=fetch(phaseQuery)  
-    orderOfKeys_phase=['Matlab ID', 'ID', 'Study Code', 'Protocol', 'Enrollment Date', 'Phase', 'Requirement', 'Status', 'Ideal Date', 'Fulfillment Date']
-    
+    return phase_prelim,fetch(phaseQuery)
+
+def fillPhaseStore(fetch,store,startdate,enddate,maxAge=MAX_AGE):
+    """ Query the days in the range that the phase DayStore is missing (see
+    DayStore.missing) and save them. Each row is saved under the day(s) of the prelim
+    (compensation/tracking) rows that it matches. The rows are the current status of
+    each requirement, so days are refreshed like the session days are (see dayStore.py).
+    Returns the (first, last) ranges that were queried. """
+    ID = orderOfKeys_phase.index('ID')
+    Protocol = orderOfKeys_phase.index('Protocol')
+    Phase = orderOfKeys_phase.index('Phase')
+    missing = store.missing(startdate,enddate,maxAge)
+    for (first,last) in missing:
+        fetchedAt = time.time()
+        (phase_prelim,queryResult_phase) = fetchPhases(fetch,first,last)
+        rows = format_query(queryResult_phase,orderOfKeys_phase)
+        rowsByDay = {}
+        for prelim in phase_prelim:
+            #same matching as the filters in fetchPhases (~ is case-insensitive "contains")
+            phase = re.split('Day',prelim['Phase'])[0].lower()
+            dayRows = rowsByDay.setdefault(prelim['FulDate'],[])
+            for row in rows:
+                if row[ID]==prelim['ID'] and row[Protocol]==prelim['Protocol'] \
+                        and phase in (row[Phase] or '').lower() and row not in dayRows:
+                    dayRows.append(row)
+        store.update(first,last,rowsByDay,fetchedAt)
+    return missing
+
+def phaseEditQuery(fetch,filename,startdate,enddate,store=None):
+    """ Run the phase editor query and write out results. If a DayStore is passed
+    in, only query the days that it's missing (see fillPhaseStore). """
+
+    if store:
+        fillPhaseStore(fetch,store,startdate,enddate)
+        store.assemble(filename,startdate,enddate,dedupe=True,sortKey='Fulfillment Date')
+        return
+
+    (phase_prelim,queryResult_phase) = fetchPhases(fetch,startdate,enddate)
     with open(filename,'w') as f:
         f_csv=csv.writer(f)
         print_headers(f_csv,orderOfKeys_phase)
@@ -257,6 +367,19 @@ def phaseEditQuery(fetch,filename,startdate,enddate):
 
     return
 
+def writeTypedMat(filename,schema):
+    """ Write the .mat file for a results file, decoded with a schema (see
+    matExport.py). Returns the SchemaError if the results don't match the schema
+    (there's no .mat file then -- any left from an earlier run is removed),
+    otherwise None. """
+    try:
+        writeMat(filename,schema=schema)
+    except SchemaError, err:
+        if os.path.exists(matName(filename)):
+            os.remove(matName(filename))
+        return err
+    return None
+
 def main(fetch=None,argsin=None):
     """ Ask user for start and end dates, run MRIC queries."""
     if not fetch:
@@ -290,19 +413,37 @@ def main(fetch=None,argsin=None):
         os.mkdir(DATE_QUERY_PATH)
     os.chdir(DATE_QUERY_PATH)
 
+    if USE_DAY_STORE:
+        sessionStore = openStore('session')
+        phaseStore = openStore('phase')
+    else:
+        sessionStore = phaseStore = None
+
     ##QUERY 1 - session table 
     filename_session=''.join(('session_',startdate,'_',enddate,RESULTSFILE))
-    sessionTableQuery(fetch,filename_session,startdate,enddate)
+    sessionTableQuery(fetch,filename_session,startdate,enddate,sessionStore)
+    writeProtocolBitmap(filename_session)
+    writeIndex(filename_session)
 
     ##QUERY 2 - phase editor. 
     filename_phase=''.join(('phase_',startdate,'_',enddate,RESULTSFILE))
-    phaseEditQuery(fetch,filename_phase,startdate,enddate)
+    phaseEditQuery(fetch,filename_phase,startdate,enddate,phaseStore)
+    writeIndex(filename_phase)
+
+    # validate both results once both queries have run, so a bad row in one
+    # doesn't lose the other
+    invalid = [(filename,err) for (filename,err) in
+               [(filename_session,writeTypedMat(filename_session,'session')),
+                (filename_phase,writeTypedMat(filename_phase,'phase'))] if err]
 
     os.chdir(ORIG_PATH)
     print " "
     print "Done. Query results saved: "
     print "    " + DATE_QUERY_PATH + filename_session
     print "    " + DATE_QUERY_PATH + filename_phase
+    for (filename,err) in invalid:
+        print "WARNING: %s doesn't match its schema, so no .mat file was written" % filename
+        print "    (weeklyCheck.m will read the csv instead): %s" % err
     print " "
 
     